@@ -16,12 +16,1000 @@ ComfyUI Video Overlay Node
 """
 
 import os
+import re
+import json
+import math
+import shutil
+import struct
+import hashlib
+import time
+import queue
+import threading
+import subprocess
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
 import ffmpeg
 import folder_paths
 from pathlib import Path
 import uuid
 FONT_DIR = os.path.join(os.path.dirname(__file__), "fonts")
 # os.path.join(FONT_DIR, font_file)
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
+
+
+class PersistentLRUCache:
+    """内存 LRU + 磁盘 JSON 持久化的小型缓存
+
+    - 内存中按最近使用顺序淘汰，最多保留 max_entries 条
+    - 每次写入后同步到 CACHE_DIR/<name>.json，ComfyUI 重启后仍然有效
+    - 值必须是可 JSON 序列化的对象
+    """
+
+    def __init__(self, name, max_entries=1024):
+        self.path = os.path.join(CACHE_DIR, f"{name}.json")
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            for key, value in entries:
+                self._data[key] = value
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[VideoOverlay] 警告: 缓存文件损坏，已忽略: {self.path} ({e})")
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def _save(self):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._data.items()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[VideoOverlay] 警告: 无法写入缓存文件: {self.path} ({e})")
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._load()
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            self._save()
+
+
+def file_fingerprint(path):
+    """文件快速指纹：绝对路径 + 大小 + 修改时间（不读取文件内容）"""
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+# ffprobe 结果缓存，字段变化时提升版本号使旧条目失效
+PROBE_CACHE_VERSION = 5
+_probe_cache = PersistentLRUCache("probe", max_entries=2048)
+
+# 带 alpha 通道的像素格式（ProRes 4444、PNG、QuickTime Animation 等）
+ALPHA_PIX_FMT_PATTERN = re.compile(r"^(yuva|ya\d|gbrap|rgba|bgra|argb|abgr)")
+# WebM 的 VP8/VP9 alpha 存放在附加数据中，原生解码器会忽略，需要改用 libvpx 解码
+ALPHA_DECODERS = {"vp8": "libvpx", "vp9": "libvpx-vp9"}
+
+
+def _parse_frame_rate(rate_str):
+    """解析 ffprobe 的 "30000/1001" 形式帧率，无效时返回 0"""
+    try:
+        num, denom = map(int, rate_str.split('/'))
+        return num / denom if denom != 0 else 0.0
+    except (AttributeError, ValueError):
+        return 0.0
+
+
+def get_media_info(video_path, use_cache=True):
+    """获取视频元数据（带缓存）
+
+    返回字典：width, height, duration, fps, pix_fmt, codec_name, profile, level, sample_aspect_ratio,
+    extradata_hash, has_alpha, alpha_decoder, has_audio, audio_codec, audio_sample_rate, audio_channels
+    以 路径+大小+修改时间 为键，文件未变化时不会重复执行 ffprobe；use_cache=False 时直接探测（用于临时文件）。
+    """
+    try:
+        cache_key = file_fingerprint(video_path)
+    except OSError as e:
+        raise ValueError(f"无法读取视频信息: {video_path}\n错误: {e}")
+
+    cached = _probe_cache.get(cache_key) if use_cache else None
+    if cached is not None and cached.get("version") == PROBE_CACHE_VERSION:
+        return dict(cached)
+
+    try:
+        # show_data_hash 输出编码器附加数据（avcC/hvcC 中的 SPS/PPS）的摘要，智能渲染拼接前用来比较
+        probe = ffmpeg.probe(video_path, show_data_hash="MD5")
+        video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+        audio_info = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
+
+        duration = probe['format'].get('duration', video_info.get('duration'))
+        fps = _parse_frame_rate(video_info.get('r_frame_rate', '')) or \
+            _parse_frame_rate(video_info.get('avg_frame_rate', '')) or 24.0
+
+        # alpha 通道：像素格式自带，或 WebM 标记了 alpha_mode=1
+        pix_fmt = video_info.get('pix_fmt', '')
+        codec_name = video_info.get('codec_name', '')
+        tags = {k.lower(): v for k, v in video_info.get('tags', {}).items()}
+        alpha_decoder = None
+        if tags.get('alpha_mode') == '1' and codec_name in ALPHA_DECODERS:
+            alpha_decoder = ALPHA_DECODERS[codec_name]
+        has_alpha = bool(ALPHA_PIX_FMT_PATTERN.match(pix_fmt)) or alpha_decoder is not None
+
+        info = {
+            "version": PROBE_CACHE_VERSION,
+            "width": int(video_info['width']),
+            "height": int(video_info['height']),
+            "duration": float(duration),
+            "fps": fps,
+            "pix_fmt": pix_fmt,
+            "codec_name": codec_name,
+            "profile": video_info.get('profile', ''),
+            "level": int(video_info.get('level', 0)),
+            "sample_aspect_ratio": video_info.get('sample_aspect_ratio', ''),
+            "extradata_hash": video_info.get('extradata_hash', ''),
+            "has_alpha": has_alpha,
+            "alpha_decoder": alpha_decoder,
+            "has_audio": audio_info is not None,
+            "audio_codec": audio_info.get('codec_name', '') if audio_info else '',
+            "audio_sample_rate": int(audio_info.get('sample_rate', 0)) if audio_info else 0,
+            "audio_channels": int(audio_info.get('channels', 0)) if audio_info else 0,
+        }
+    except Exception as e:
+        raise ValueError(f"无法读取视频信息: {video_path}\n错误: {e}")
+
+    if use_cache:
+        _probe_cache.put(cache_key, info)
+    return dict(info)
+
+# 关键帧位置缓存（智能渲染按关键帧切分），按文件指纹缓存
+_keyframe_cache = PersistentLRUCache("keyframes", max_entries=512)
+
+
+def get_keyframes(video_path):
+    """读取视频流所有关键帧的 (pts, dts)（带缓存）
+
+    只解复用不解码，返回 {"start": 第一帧时间戳, "keyframes": [[pts, dts], ...]}，时间为文件内的原始时间戳（秒）
+    """
+    cache_key = file_fingerprint(video_path)
+    cached = _keyframe_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        probe = ffmpeg.probe(video_path, select_streams="v:0", show_entries="packet=pts_time,dts_time,flags")
+    except ffmpeg.Error as e:
+        error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+        raise ValueError(f"无法读取关键帧: {video_path}\n错误: {error_msg}")
+
+    start = None
+    keyframes = []
+    for packet in probe.get("packets", []):
+        try:
+            pts = float(packet["pts_time"])
+        except (KeyError, ValueError):
+            continue
+        start = pts if start is None else min(start, pts)
+        if packet.get("flags", "").startswith("K"):
+            try:
+                dts = float(packet["dts_time"])
+            except (KeyError, ValueError):
+                dts = pts
+            keyframes.append([pts, dts])
+
+    result = {"start": start or 0.0, "keyframes": sorted(keyframes)}
+    _keyframe_cache.put(cache_key, result)
+    return result
+
+
+# 渲染结果缓存：输出文件名由输入指纹 + 参数哈希决定，相同输入直接复用
+RENDER_CACHE_MAX_BYTES = 20 * 1024 ** 3
+RENDER_CACHE_PATTERN = re.compile(r"^overlay(_subtitle|_layers)?_[0-9a-f]{16}\.mp4$")
+
+
+# 已调速的大视频中间文件（background_cache）：按源文件指纹 + 速度命名，跨渲染、跨重启复用
+BACKGROUND_CACHE_DIR = os.path.join(CACHE_DIR, "backgrounds")
+BACKGROUND_CACHE_MAX_BYTES = 10 * 1024 ** 3
+BACKGROUND_CACHE_PATTERN = re.compile(r"^background_[0-9a-f]{16}\.mkv$")
+# 中间文件的格式变化时提升版本号，使旧文件不再命中
+BACKGROUND_CACHE_VERSION = 2
+BACKGROUND_CRF = 12
+
+# 字幕节点的分层缓存：不带字幕的合成结果（高质量中间文件），只改字幕时在它上面重新烧录
+COMPOSITE_CACHE_DIR = os.path.join(CACHE_DIR, "composites")
+COMPOSITE_CACHE_MAX_BYTES = 10 * 1024 ** 3
+COMPOSITE_CACHE_PATTERN = re.compile(r"^composite_[0-9a-f]{16}\.mp4$")
+COMPOSITE_CRF = 12
+# 只影响字幕的输入，以及只影响最终编码的输入：都不参与合成结果的缓存键
+SUBTITLE_INPUT_KEYS = ("alignment", "font_path", "font_size", "font_color", "x_position", "y_position",
+                       "subtitle_position", "max_subtitle_width", "subtitle_bg_opacity", "subtitle_bg_color",
+                       "subtitle_renderer", "merge_cues", "cue_max_gap", "cue_max_chars", "cue_max_duration")
+COMPOSITE_IGNORED_INPUTS = ("encoder_preset", "crf", "threads", "video_codec", "parallel_segments",
+                            "composite_cache")
+
+# 只影响渲染速度、不影响输出画面的输入，不参与缓存键
+RENDER_KEY_IGNORED_INPUTS = ("background_cache", "composite_cache")
+
+# 只影响音频的输入：其余输入相同的渲染结果画面完全相同，只改这些时复制已有结果的视频流、只重新渲染音频
+AUDIO_INPUT_KEYS = ("big_video_audio_volume", "small_video_audio_volume")
+# 画面缓存键 → 最近一次渲染的输出文件名
+_video_render_index = PersistentLRUCache("video_renders", max_entries=1024)
+
+
+def normalize_params(value):
+    """规范化参数，保证同一组参数得到同一个哈希（浮点数去掉计算误差）"""
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, AlignmentTrack):
+        return normalize_params(value.to_list())
+    if isinstance(value, dict):
+        return {str(k): normalize_params(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_params(v) for v in value]
+    return value
+
+
+def compute_cache_key(input_paths, params):
+    """由输入文件指纹和规范化参数计算缓存键（sha1 十六进制）"""
+    payload = {
+        "inputs": [file_fingerprint(path) for path in input_paths],
+        "params": normalize_params(params),
+    }
+    data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def lookup_render_cache(output_path):
+    """检查渲染缓存是否命中，命中时刷新修改时间（用于 LRU 淘汰）"""
+    if os.path.isfile(output_path) and os.path.getsize(output_path) > 0:
+        os.utime(output_path, None)
+        return True
+    return False
+
+
+def evict_render_cache(output_dir, max_bytes=RENDER_CACHE_MAX_BYTES, pattern=RENDER_CACHE_PATTERN, keep=()):
+    """缓存的渲染结果总大小超过上限时，按最久未使用顺序删除
+
+    只处理文件名匹配 pattern 的文件（默认为本节点生成的 overlay_<哈希>.mp4），不会动目录里的其他文件；
+    keep 中的文件（刚生成的、当前渲染还要读取的）不会被删除，但仍计入总大小。
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    for name in os.listdir(output_dir):
+        if not pattern.match(name):
+            continue
+        path = os.path.join(output_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            print(f"[VideoOverlay] 缓存超出上限，已删除: {os.path.basename(path)}")
+        except OSError:
+            pass
+
+
+def lookup_video_render(video_key):
+    """查找画面相同的已有渲染结果，返回文件路径；没有或文件已被删除时返回 None"""
+    if video_key is None:
+        return None
+    output_filename = _video_render_index.get(video_key)
+    if not output_filename:
+        return None
+    output_path = os.path.join(folder_paths.get_output_directory(), output_filename)
+    return output_path if lookup_render_cache(output_path) else None
+
+
+class VideoGraph:
+    """VIDEO_GRAPH 类型：尚未渲染的合成结果
+
+    保存生成它的节点、plan 和编码选项，本身不写任何文件。下游节点把它当作大视频时，
+    它的滤镜图直接接在下游滤镜图的前面，整条节点链只用一个 ffmpeg 进程渲染；
+    也可以交给 VideoGraphRenderNode 单独渲染。渲染结果与生成它的节点直接渲染的文件相同，共用渲染缓存。
+    plan 为 None 表示节点命中了渲染缓存，只能以文件的形式使用。
+    video_key 为画面缓存键（不含音量），给出时画面相同的已有结果只重新渲染音频。
+    """
+
+    def __init__(self, node, render_key, output_filename, plan=None, layer_plans=None, encoding=None,
+                 parallel_segments=1, allow_passthrough=True, video_key=None):
+        self.node = node
+        self.render_key = render_key
+        self.video_key = video_key
+        self.output_filename = output_filename
+        self.plan = plan
+        self.layer_plans = layer_plans
+        self.encoding = encoding
+        self.parallel_segments = parallel_segments
+        self.allow_passthrough = allow_passthrough
+        # 节点链中的第几层合成（从 1 开始），用于区分各层相同输入文件的滤镜链
+        source = plan["big_video_path"] if plan else None
+        self.depth = source.depth + 1 if isinstance(source, VideoGraph) else 1
+
+    @property
+    def output_path(self):
+        return os.path.join(folder_paths.get_output_directory(), self.output_filename)
+
+    @property
+    def info(self):
+        """合成结果的元数据，字段与 get_media_info 相同"""
+        plan = self.plan
+        return {
+            "width": plan["canvas_w"],
+            "height": plan["canvas_h"],
+            "duration": plan["max_dur"],
+            "fps": plan["frame_rate"],
+            "pix_fmt": "yuv420p",
+            "codec_name": "",
+            "has_alpha": False,
+            "alpha_decoder": None,
+            "has_audio": self.node.plan_audio(plan, self.layer_plans)["audible"],
+            "audio_codec": "",
+            "audio_sample_rate": 0,
+            "audio_channels": 0,
+        }
+
+    def resolve(self):
+        """已经渲染过时返回文件路径（可以使用智能渲染等只对文件有效的优化），否则返回自身"""
+        if lookup_render_cache(self.output_path):
+            return self.output_path
+        if self.plan is None:
+            raise RuntimeError(f"视频图对应的渲染结果已被删除，请重新执行上游节点: {self.output_filename}")
+        return self
+
+    def build(self, segment=None):
+        """构建合成结果的 (视频流, 音频流)；segment 的含义与 build_overlay_graph 相同"""
+        return self.node.build_output(self.plan, segment, self.layer_plans)
+
+    def render(self, show_progress=True):
+        """渲染到输出目录（命中渲染缓存时直接返回），返回输出路径"""
+        output_path = self.output_path
+        if lookup_render_cache(output_path):
+            print(f"[VideoOverlay] ✓ 命中渲染缓存: {self.output_filename}")
+            return output_path
+        if self.plan is None:
+            raise RuntimeError(f"视频图对应的渲染结果已被删除，请重新执行上游节点: {self.output_filename}")
+
+        # 先写入临时文件，完成后再改名，避免中断留下的残缺文件被当成缓存；
+        # 文件名唯一，批量中渲染键相同的条目同时渲染时不会写同一个文件
+        partial_path = f"{output_path}.{uuid.uuid4().hex}.partial.mp4"
+        video_path = lookup_video_render(self.video_key)
+        try:
+            if video_path:
+                print(f"[VideoOverlay] ✓ 画面与 {os.path.basename(video_path)} 相同，只重新渲染音频")
+                self.node.remux_audio(self.plan, video_path, partial_path, self.layer_plans, show_progress)
+            else:
+                self.node.render_plan(
+                    self.plan, partial_path, self.encoding, self.parallel_segments, self.layer_plans,
+                    self.allow_passthrough, show_progress
+                )
+            os.replace(partial_path, output_path)
+        except ffmpeg.Error as e:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+            print(f"[VideoOverlay] ✗ FFmpeg错误:\n{error_msg}")
+            raise RuntimeError(f"视频合成失败: {error_msg}")
+        except Exception as e:
+            # 包括用户中断：删除未完成的临时文件
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            print(f"[VideoOverlay] ✗ 处理失败: {e}")
+            raise
+        evict_render_cache(os.path.dirname(output_path), keep=[output_path])
+        if self.video_key is not None:
+            _video_render_index.put(self.video_key, self.output_filename)
+
+        print(f"[VideoOverlay] ✓ 合成完成: {self.output_filename}")
+        return output_path
+
+
+# 循环背景视频时，只有解码后的整段视频+音频不超过此大小才使用 loop/aloop 滤镜（全部缓存在内存中），
+# 否则使用输入级 -stream_loop 重新读取文件，内存占用与视频长度无关
+LOOP_FILTER_MAX_BYTES = 256 * 1024 ** 2
+# 裁剪后循环时拼接的各段输入的 -thread_queue_size 起始值（ffmpeg 默认 8），逐段加一使各段输入互不相同
+LOOP_PIECE_QUEUE_SIZE = 8
+
+# 分段并行渲染时每段的最短时长（秒），太短的段拼接开销大于收益
+MIN_SEGMENT_SECONDS = 2.0
+
+# 智能渲染：输出编码器与可以直接复制的源视频编码
+STREAM_COPY_CODECS = {"libx264": "h264", "libx265": "hevc"}
+# 智能渲染拼接时必须一致的视频流参数：MP4 只保留第一个输入的 avcC/hvcC（SPS/PPS），
+# 重新编码的区间与复制的区间参数不同时，只按文件头初始化的解码器（硬件解码、浏览器）会花屏或报错
+STREAM_SIGNATURE_FIELDS = (
+    "codec_name", "pix_fmt", "profile", "level", "width", "height", "sample_aspect_ratio", "extradata_hash"
+)
+# 不需要调速/调音量/混音时可以直接复制到 MP4 的音频编码
+STREAM_COPY_AUDIO_CODECS = ("aac", "mp3", "alac", "ac3", "eac3")
+
+# ffmpeg 子进程：stderr 只保留最后这么多行用于报错
+STDERR_TAIL_LINES = 200
+# 滤镜图文本超过该长度时写入临时文件，用 -filter_complex_script 传给 ffmpeg（避免命令行超出 ARG_MAX）
+FILTER_SCRIPT_MIN_CHARS = 8192
+# 预先编译好的滤镜链文本（如上千条 drawtext 字幕）在内存中最多缓存这么多条；
+# 分段渲染时每段一条，需要大于最大分段数，保证运行前不会被淘汰
+FILTER_CHAIN_CACHE_ENTRIES = 128
+# 检查中断的间隔、进度条精度、控制台打印进度的间隔
+PROGRESS_POLL_SECONDS = 0.25
+PROGRESS_BAR_STEPS = 1000
+PROGRESS_REPORT_SECONDS = 2.0
+
+# mask 分析：亮度不超过该值的像素视为透明；裁剪后面积不足原画面该比例时才裁剪
+MASK_EMPTY_THRESHOLD = 8
+MASK_CROP_MAX_AREA = 0.9
+# 静态 mask 检测：先比较这么多个均匀抽样帧的哈希，全部相同才做逐帧校验
+MASK_STATIC_SAMPLES = 5
+# mask 为空的区间：短于该时长的空隙不跳过；区间太多或覆盖了几乎整条时间轴时不生成 enable 表达式
+MASK_MIN_GAP_SECONDS = 0.5
+MASK_MAX_INTERVALS = 64
+MASK_MAX_ACTIVE_RATIO = 0.95
+
+# 编码档位：draft 用于调整布局时快速预览，final 用于最终交付
+ENCODING_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 28, "scale_flags": "fast_bilinear", "downscale": True},
+    "balanced": {"preset": "medium", "crf": 23, "scale_flags": "bicubic", "downscale": False},
+    "final": {"preset": "slow", "crf": 18, "scale_flags": "lanczos", "downscale": False},
+}
+ENCODER_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast",
+                   "medium", "slow", "slower", "veryslow"]
+
+# 输出分辨率：按短边限制（竖屏视频同样适用），只缩小不放大
+OUTPUT_RESOLUTIONS = {
+    "source": None,
+    "2160p": 2160,
+    "1440p": 1440,
+    "1080p": 1080,
+    "720p": 720,
+    "540p": 540,
+    "480p": 480,
+}
+
+
+# 入点/出点参数（源时间，秒）
+TRIM_KEYS = ("big_start", "big_end", "small_start", "small_end")
+
+
+def render_input_types():
+    """两个合成节点共用的编码/渲染参数输入（放在 optional 中，保持旧工作流的控件顺序）"""
+    return {
+        "encoding_profile": (["balanced", "draft", "final"], {
+            "default": "balanced"
+        }),
+        "encoder_preset": (["auto"] + ENCODER_PRESETS, {
+            "default": "auto"
+        }),
+        "crf": ("INT", {
+            "default": -1,  # -1 表示使用档位默认值
+            "min": -1,
+            "max": 51,
+            "step": 1,
+        }),
+        "threads": ("INT", {
+            "default": 0,  # 0 表示由编码器自动决定
+            "min": 0,
+            "max": 64,
+            "step": 1,
+        }),
+        "video_codec": (["auto", "libx264", "libx265"], {
+            "default": "auto"
+        }),
+        "draft_downscale": ("FLOAT", {
+            "default": 0.5,  # 仅 draft 档位生效，1.0 表示不缩小
+            "min": 0.25,
+            "max": 1.0,
+            "step": 0.05,
+            "display": "slider",
+        }),
+        "parallel_segments": ("INT", {
+            "default": 1,  # 1 表示整条时间轴一次渲染
+            "min": 1,
+            "max": 32,
+            "step": 1,
+        }),
+        "mask_analysis": ("BOOLEAN", {
+            "default": True,  # 预先分析 mask 范围，只合成有内容的区域
+        }),
+        "output_resolution": (list(OUTPUT_RESOLUTIONS), {
+            "default": "source"  # 先把大视频缩小到该分辨率再合成
+        }),
+        **{
+            key: ("FLOAT", {
+                "default": 0.0,
+                "min": 0.0,
+                "max": 86400.0,
+                "step": 0.1,  # 入点/出点（秒），出点为 0 表示到结尾
+            })
+            for key in TRIM_KEYS
+        },
+        "overlay_start": ("FLOAT", {
+            "default": 0.0,
+            "min": 0.0,
+            "max": 86400.0,
+            "step": 0.1,  # 画中画（和字幕）从输出的第几秒开始显示
+        }),
+        "overlay_end": ("FLOAT", {
+            "default": 0.0,
+            "min": 0.0,
+            "max": 86400.0,
+            "step": 0.1,  # 画中画显示到第几秒，0 表示到结尾；窗口外的画面直接复制大视频
+        }),
+    }
+
+
+# 视频图相关的输入：不参与渲染参数，上游视频图按它的缓存键参与缓存键计算
+GRAPH_INPUT_KEYS = ("big_video_graph", "lazy_output")
+
+
+def graph_input_types():
+    """把上游节点的视频图作为大视频，以及只输出视频图不渲染的开关"""
+    return {
+        "big_video_graph": ("VIDEO_GRAPH",),  # 连接后代替 big_video_path
+        "lazy_output": ("BOOLEAN", {
+            "default": False,  # 只输出 video_graph，由下游节点或 Render Video Graph 节点一起渲染
+        }),
+    }
+
+
+def pop_graph_inputs(inputs):
+    """去掉节点输入中视频图相关的项，返回 (其余输入, 上游视频图)；有上游视频图时忽略 big_video_path"""
+    graph = inputs.get("big_video_graph")
+    inputs = {k: v for k, v in inputs.items() if k not in GRAPH_INPUT_KEYS}
+    if graph is not None:
+        inputs["big_video_path"] = ""
+    return inputs, graph
+
+
+def resolve_encoding_options(encoding_profile="balanced", encoder_preset="auto", crf=-1,
+                             threads=0, video_codec="auto", draft_downscale=0.5, output_resolution="source"):
+    """合并编码档位与手动覆盖参数
+
+    downscale 为 draft 档位的画布缩放比例；max_short_side 为输出分辨率限制的短边像素数（None 表示不限制）
+    """
+    profile = ENCODING_PROFILES.get(encoding_profile, ENCODING_PROFILES["balanced"])
+    return {
+        "vcodec": "libx264" if video_codec == "auto" else video_codec,
+        "preset": profile["preset"] if encoder_preset == "auto" else encoder_preset,
+        "crf": profile["crf"] if crf < 0 else crf,
+        "threads": threads,
+        "scale_flags": profile["scale_flags"],
+        "downscale": draft_downscale if profile["downscale"] else 1.0,
+        "max_short_side": OUTPUT_RESOLUTIONS.get(output_resolution),
+    }
+
+
+def get_output_kwargs(encoding):
+    """编码参数 → ffmpeg.output 的视频编码关键字参数"""
+    kwargs = {
+        'vcodec': encoding["vcodec"],
+        'preset': encoding["preset"],
+        'crf': encoding["crf"],
+        'movflags': '+faststart',  # 启用流式播放
+    }
+    if encoding["threads"] > 0:
+        kwargs['threads'] = encoding["threads"]
+    if encoding["vcodec"] == "libx265":
+        # 让 Safari/QuickTime 能识别 HEVC
+        kwargs['tag:v'] = 'hvc1'
+    return kwargs
+
+
+def comfy_progress_bar(total):
+    """创建 ComfyUI 进度条；不在 ComfyUI 中运行时返回 None"""
+    try:
+        import comfy.utils
+    except ImportError:
+        return None
+    return comfy.utils.ProgressBar(total)
+
+
+def check_interrupted():
+    """用户点击了 ComfyUI 的中断按钮时抛出 InterruptProcessingException
+
+    不重置中断标志，这样并行运行的其他 ffmpeg 进程也能看到并各自停止
+    """
+    try:
+        import comfy.model_management as model_management
+    except ImportError:
+        return
+    if model_management.processing_interrupted():
+        raise model_management.InterruptProcessingException()
+
+
+def parse_progress(status):
+    """解析 -progress 输出的一组 key=value；时间为 N/A 时 seconds 为 None"""
+    seconds = None
+    # out_time_ms 在旧版本 ffmpeg 中实际单位也是微秒
+    for key in ("out_time_us", "out_time_ms"):
+        try:
+            seconds = max(0.0, int(status[key]) / 1_000_000)
+            break
+        except (KeyError, ValueError):
+            continue
+    try:
+        frame = int(status.get("frame", 0))
+    except ValueError:
+        frame = 0
+    return {"seconds": seconds, "frame": frame, "end": status.get("progress") == "end"}
+
+
+def terminate_process(process):
+    """先发送 SIGTERM 让 ffmpeg 正常收尾，超时后强制结束"""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+_filter_chain_cache = OrderedDict()
+_filter_chain_lock = threading.Lock()
+FILTER_CHAIN_PATTERN = re.compile(r"null=filter_chain_([0-9a-f]{16})")
+
+
+def escape_filter_chars(text, chars):
+    """在 chars 中的字符前加反斜杠（反斜杠本身最先处理）"""
+    text = str(text)
+    for ch in sorted(set(chars), key=lambda c: c != '\\'):
+        text = text.replace(ch, '\\' + ch)
+    return text
+
+
+def format_filter(name, **kwargs):
+    """把一个滤镜格式化为滤镜图文本，转义规则与 ffmpeg-python 完全相同（先转义选项，整体再按滤镜图转义）"""
+    option_chars = "\\'=:"
+    params = ":".join(
+        f"{escape_filter_chars(key, option_chars)}={escape_filter_chars(value, option_chars)}"
+        for key, value in sorted(kwargs.items())
+    )
+    text = escape_filter_chars(name, option_chars) + (f"={params}" if params else "")
+    return escape_filter_chars(text, "\\'[],;")
+
+
+def apply_filter_chain(stream, params, build_filters):
+    """在 stream 后串联一条预编译的滤镜链
+
+    build_filters() 返回滤镜文本列表（见 format_filter），结果按 params 的哈希缓存，
+    相同参数再次渲染时不再在 Python 中逐个构建上千个滤镜节点。
+    滤镜图中只放一个占位的 null 滤镜，由 compile_ffmpeg 替换为缓存的滤镜链。
+    """
+    key = compute_cache_key([], params)[:16]
+    with _filter_chain_lock:
+        cached = key in _filter_chain_cache
+        if cached:
+            _filter_chain_cache.move_to_end(key)
+    if not cached:
+        chain = ",".join(build_filters())
+        with _filter_chain_lock:
+            _filter_chain_cache[key] = chain
+            while len(_filter_chain_cache) > FILTER_CHAIN_CACHE_ENTRIES:
+                _filter_chain_cache.popitem(last=False)
+    return ffmpeg.filter(stream, 'null', f'filter_chain_{key}')
+
+
+def expand_filter_chains(graph):
+    """把滤镜图中的占位滤镜替换为缓存的滤镜链"""
+    def replace(match):
+        with _filter_chain_lock:
+            chain = _filter_chain_cache.get(match.group(1))
+        if chain is None:
+            raise RuntimeError(f"滤镜链缓存已失效: {match.group(1)}")
+        return chain
+    return FILTER_CHAIN_PATTERN.sub(replace, graph)
+
+
+# 构建滤镜图时写入的临时文件（如 ASS 字幕），由引用它的 ffmpeg 进程结束后删除
+_graph_temp_files = set()
+_graph_temp_lock = threading.Lock()
+
+
+def register_graph_temp_file(path):
+    """登记滤镜图引用的临时文件；文件名必须唯一，run_ffmpeg 运行完引用它的命令后删除"""
+    with _graph_temp_lock:
+        _graph_temp_files.add(path)
+    return path
+
+
+def claim_graph_temp_files(graph):
+    """取出滤镜图文本中引用到的已登记临时文件（按文件名匹配）"""
+    with _graph_temp_lock:
+        claimed = [path for path in _graph_temp_files if os.path.basename(path) in graph]
+        _graph_temp_files.difference_update(claimed)
+    return claimed
+
+
+def compile_ffmpeg(stream_spec):
+    """编译 ffmpeg 命令行，返回 (参数列表, 运行结束后要删除的临时文件列表)
+
+    展开预编译的滤镜链；滤镜图很长时写入临时脚本文件，改用 -filter_complex_script。
+    临时文件包括脚本文件和滤镜图引用的已登记文件（见 register_graph_temp_file），调用方负责删除。
+    """
+    args = ffmpeg.compile(stream_spec, overwrite_output=True)
+    if "-filter_complex" not in args:
+        return args, []
+    idx = args.index("-filter_complex")
+    graph = expand_filter_chains(args[idx + 1])
+    temp_files = claim_graph_temp_files(graph)
+    if len(graph) < FILTER_SCRIPT_MIN_CHARS:
+        args[idx + 1] = graph
+        return args, temp_files
+
+    script_path = os.path.join(
+        folder_paths.get_temp_directory(), f"filter_graph_{str(uuid.uuid4())[:8]}.txt"
+    )
+    os.makedirs(os.path.dirname(script_path), exist_ok=True)
+    with open(script_path, "w", encoding="utf-8") as f:
+        f.write(graph)
+    args[idx:idx + 2] = ["-filter_complex_script", script_path]
+    return args, temp_files + [script_path]
+
+
+def remove_temp_files(paths):
+    """删除临时文件，已经不存在的忽略"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def run_ffmpeg(stream_spec, on_progress=None):
+    """以受管理的子进程运行 ffmpeg
+
+    - 通过 -progress pipe:1 读取进度，每次更新调用 on_progress(进度字典)
+    - 定期检查 ComfyUI 中断，中断时结束子进程
+    - stderr 只保留最后 STDERR_TAIL_LINES 行，失败时作为 ffmpeg.Error 的 stderr 抛出
+    """
+    args, temp_files = compile_ffmpeg(stream_spec)
+    args = args[:1] + ["-hide_banner", "-nostats", "-progress", "pipe:1"] + args[1:]
+    try:
+        process = subprocess.Popen(
+            args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except BaseException:
+        remove_temp_files(temp_files)
+        raise
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    updates = queue.Queue()
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line)
+
+    def read_progress():
+        status = {}
+        for line in process.stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            status[key] = value
+            # 每组进度以 progress=continue/end 结尾
+            if key == "progress":
+                updates.put(parse_progress(status))
+                status = {}
+
+    readers = [
+        threading.Thread(target=read_stderr, daemon=True),
+        threading.Thread(target=read_progress, daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        while process.poll() is None:
+            try:
+                status = updates.get(timeout=PROGRESS_POLL_SECONDS)
+            except queue.Empty:
+                status = None
+            check_interrupted()
+            if status and on_progress:
+                on_progress(status)
+    except BaseException:
+        terminate_process(process)
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+        remove_temp_files(temp_files)
+
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, b"".join(stderr_tail))
+
+
+class RenderProgress:
+    """汇总一个或多个 ffmpeg 进程的进度（按已输出的秒数），驱动 ComfyUI 进度条并定期打印帧数、速度和预计剩余时间"""
+
+    def __init__(self, total_seconds):
+        self.total_seconds = max(float(total_seconds), 1e-3)
+        self.seconds = {}
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.bar = comfy_progress_bar(PROGRESS_BAR_STEPS)
+
+    def callback(self, job=0):
+        """返回给 run_ffmpeg 的回调；并行的多个进程用不同的 job 区分"""
+        return lambda status: self.update(job, status)
+
+    def update(self, job, status):
+        with self.lock:
+            if status["seconds"] is not None:
+                self.seconds[job] = status["seconds"]
+            self.frames[job] = status["frame"]
+            fraction = min(1.0, sum(self.seconds.values()) / self.total_seconds)
+            if self.bar:
+                self.bar.update_absolute(int(fraction * PROGRESS_BAR_STEPS), PROGRESS_BAR_STEPS)
+
+            now = time.monotonic()
+            if now - self.last_report < PROGRESS_REPORT_SECONDS and not status["end"]:
+                return
+            self.last_report = now
+            elapsed = max(now - self.started, 1e-3)
+            frames = sum(self.frames.values())
+            eta = f"{elapsed * (1.0 - fraction) / fraction:.0f}秒" if fraction > 0 else "未知"
+            print(f"[VideoOverlay] 进度 {fraction * 100:.0f}% | 帧 {frames} | {frames / elapsed:.1f}fps | 剩余约 {eta}")
+
+
+# mask 分析结果缓存：按 mask 文件指纹缓存，文件不变时只分析一次
+MASK_ANALYSIS_VERSION = 3
+_mask_analysis_cache = PersistentLRUCache("mask_analysis", max_entries=1024)
+
+
+def read_frame_hashes(md5_path):
+    """读取 framemd5 输出中每一帧的哈希"""
+    with open(md5_path, encoding="utf-8") as f:
+        return [line.rsplit(",", 1)[-1].strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def sample_mask_hashes(mask_path, duration, work_dir):
+    """在时间轴上均匀抽取 MASK_STATIC_SAMPLES 帧（输入级定位，只解码附近的 GOP），返回各帧哈希"""
+    samples = []
+    for idx in range(MASK_STATIC_SAMPLES):
+        seek = duration * idx / MASK_STATIC_SAMPLES
+        stream = ffmpeg.input(mask_path, ss=seek).video if seek > 0 else ffmpeg.input(mask_path).video
+        stream = ffmpeg.filter(stream, 'format', 'gray')
+        stream = ffmpeg.filter(stream, 'trim', end_frame=1)
+        samples.append(ffmpeg.filter(stream, 'setpts', f'{idx}/TB'))
+    md5_path = os.path.join(work_dir, "samples.md5")
+    run_ffmpeg(ffmpeg.output(ffmpeg.concat(*samples, v=1, a=0), md5_path, f='framemd5'))
+    return read_frame_hashes(md5_path)
+
+
+def analyze_mask(mask_path, from_alpha=False, decoder=None):
+    """分析 mask（带缓存）
+
+    from_alpha 为 True 时分析视频自带的 alpha 通道；decoder 为强制使用的解码器（VP8/VP9 alpha）。
+    返回字典：
+    - bbox: 整段视频所有非零像素的并集 [x, y, w, h]，从未出现非零像素时为 None。
+      亮度不超过 MASK_EMPTY_THRESHOLD 的像素视为透明（压缩噪声）
+    - static: mask 的每一帧是否完全相同（只检测独立的 mask 文件）。
+      先比较抽样帧的哈希，全部相同时在同一次解码中逐帧校验
+    - active: mask 非空的时间区间 [[开始, 结束], ...]（源时间，秒）
+    - ends_active: 最后一帧是否非空（冻结最后一帧时决定是否一直显示）
+    """
+    cache_key = f"{file_fingerprint(mask_path)}|{'alpha' if from_alpha else 'luma'}"
+    cached = _mask_analysis_cache.get(cache_key)
+    if cached is not None and cached.get("version") == MASK_ANALYSIS_VERSION:
+        return dict(cached)
+
+    print(f"[VideoOverlay] 正在分析mask: {os.path.basename(mask_path)}")
+    work_dir = os.path.join(
+        folder_paths.get_temp_directory(), f"mask_analysis_{str(uuid.uuid4())[:8]}"
+    )
+    os.makedirs(work_dir, exist_ok=True)
+    metadata_path = os.path.join(work_dir, "bbox.txt")
+    md5_path = os.path.join(work_dir, "frames.md5")
+    try:
+        # 抽样帧已经不同时不需要逐帧哈希
+        verify_static = False
+        if not from_alpha:
+            sample_hashes = sample_mask_hashes(mask_path, get_media_info(mask_path)["duration"], work_dir)
+            verify_static = len(set(sample_hashes)) == 1
+
+        input_kwargs = {"vcodec": decoder} if decoder else {}
+        stream = ffmpeg.input(mask_path, **input_kwargs).video
+        stream = ffmpeg.filter(stream, 'alphaextract') if from_alpha else ffmpeg.filter(stream, 'format', 'gray')
+        if verify_static:
+            branches = stream.split()
+            stream = branches[0]
+        # bbox 只为有非零像素的帧写入元数据
+        stream = ffmpeg.filter(stream, 'bbox', min_val=MASK_EMPTY_THRESHOLD)
+        stream = ffmpeg.filter(stream, 'metadata', mode='print', file=metadata_path)
+        output_stream = ffmpeg.output(stream, '-', f='null')
+        if verify_static:
+            output_stream = ffmpeg.merge_outputs(
+                output_stream, ffmpeg.output(branches[1], md5_path, f='framemd5')
+            )
+        run_ffmpeg(output_stream)
+
+        with open(metadata_path, encoding="utf-8") as f:
+            metadata = f.read()
+        static = verify_static and len(set(read_frame_hashes(md5_path))) == 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    x1 = y1 = math.inf
+    x2 = y2 = -1
+    for name, value in re.findall(r"lavfi\.bbox\.(x1|y1|x2|y2)=(\d+)", metadata):
+        value = int(value)
+        if name == "x1":
+            x1 = min(x1, value)
+        elif name == "y1":
+            y1 = min(y1, value)
+        elif name == "x2":
+            x2 = max(x2, value)
+        else:
+            y2 = max(y2, value)
+
+    # 非空帧的时间戳合并成区间，相邻帧间隔不超过 1.5 帧视为连续
+    info = get_media_info(mask_path)
+    frame_dur = 1.0 / info["fps"]
+    times = [float(t) for t in re.findall(r"pts_time:(\S+)\nlavfi\.bbox", metadata)]
+    active = []
+    for t in times:
+        if active and t - active[-1][1] <= frame_dur * 0.5:
+            active[-1][1] = t + frame_dur
+        else:
+            active.append([t, t + frame_dur])
+
+    analysis = {
+        "version": MASK_ANALYSIS_VERSION,
+        "bbox": [x1, y1, x2 - x1 + 1, y2 - y1 + 1] if x2 >= 0 else None,
+        "static": static,
+        "active": [[round(a, 6), round(b, 6)] for a, b in active],
+        "ends_active": bool(times) and times[-1] >= info["duration"] - frame_dur * 1.5,
+    }
+    _mask_analysis_cache.put(cache_key, analysis)
+    return dict(analysis)
+
+
+def get_mask_still(mask_path):
+    """把静态 mask 的第一帧解码成灰度 PNG（存放在 ComfyUI 临时目录，按文件指纹命名，缺失时重新生成）"""
+    digest = hashlib.sha1(file_fingerprint(mask_path).encode("utf-8")).hexdigest()[:16]
+    still_dir = os.path.join(folder_paths.get_temp_directory(), "video_overlay_masks")
+    still_path = os.path.join(still_dir, f"{digest}.png")
+    if not os.path.exists(still_path):
+        os.makedirs(still_dir, exist_ok=True)
+        partial_path = f"{still_path}.{str(uuid.uuid4())[:8]}.png"
+        stream = ffmpeg.filter(ffmpeg.input(mask_path).video, 'format', 'gray')
+        run_ffmpeg(ffmpeg.output(stream, partial_path, vframes=1))
+        os.replace(partial_path, still_path)
+    return still_path
+
 
 def get_available_fonts():
     """获取可用的字体列表"""
@@ -54,6 +1042,79 @@ def get_available_fonts():
     return fonts
 
 
+def get_font_name(font_path):
+    """从 TTF/OTF 的 name 表读取字体全名（libass 按名称匹配字体）
+
+    优先使用 Windows 平台的全名（nameID 4），其次是字体族名（nameID 1），
+    读取失败时退回到文件名。
+    """
+    fallback = os.path.splitext(os.path.basename(font_path))[0]
+    try:
+        with open(font_path, "rb") as f:
+            data = f.read()
+        num_tables = struct.unpack(">H", data[4:6])[0]
+        for i in range(num_tables):
+            tag, _, offset, _ = struct.unpack(">4sIII", data[12 + 16 * i:28 + 16 * i])
+            if tag != b"name":
+                continue
+            _, count, string_offset = struct.unpack(">HHH", data[offset:offset + 6])
+            names = {}
+            for j in range(count):
+                record = data[offset + 6 + 12 * j:offset + 18 + 12 * j]
+                platform_id, _, _, name_id, length, str_offset = struct.unpack(">HHHHHH", record)
+                if name_id not in (1, 4):
+                    continue
+                start = offset + string_offset + str_offset
+                raw = data[start:start + length]
+                encoding = "utf-16-be" if platform_id in (0, 3) else "latin-1"
+                names.setdefault((name_id, platform_id), raw.decode(encoding, "replace"))
+            # Windows 平台（3）优先，其次 Unicode（0）和 Mac（1）
+            for key in ((4, 3), (4, 0), (4, 1), (1, 3), (1, 0), (1, 1)):
+                if names.get(key):
+                    return names[key]
+            return fallback
+    except (OSError, struct.error):
+        pass
+    return fallback
+
+
+# 常用 FFmpeg 颜色名 → RGB
+NAMED_COLORS = {
+    "white": (255, 255, 255), "black": (0, 0, 0), "red": (255, 0, 0),
+    "green": (0, 128, 0), "lime": (0, 255, 0), "blue": (0, 0, 255),
+    "yellow": (255, 255, 0), "cyan": (0, 255, 255), "magenta": (255, 0, 255),
+    "orange": (255, 165, 0), "purple": (128, 0, 128), "pink": (255, 192, 203),
+    "gray": (128, 128, 128), "grey": (128, 128, 128), "silver": (192, 192, 192),
+    "gold": (255, 215, 0), "navy": (0, 0, 128), "brown": (165, 42, 42),
+}
+
+
+def to_ass_color(color, opacity=1.0):
+    """把 FFmpeg 颜色写法（white / #RRGGBB / 0xRRGGBB / white@0.5）转换为 ASS 的 &HAABBGGRR"""
+    color = (color or "white").strip()
+    if "@" in color:
+        color, alpha = color.split("@", 1)
+        try:
+            opacity = opacity * float(alpha)
+        except ValueError:
+            pass
+
+    value = color.lower()
+    if value in NAMED_COLORS:
+        r, g, b = NAMED_COLORS[value]
+    else:
+        hex_value = value[1:] if value.startswith("#") else value[2:] if value.startswith("0x") else value
+        try:
+            r, g, b = int(hex_value[0:2], 16), int(hex_value[2:4], 16), int(hex_value[4:6], 16)
+        except ValueError:
+            print(f"[VideoOverlay] 警告: 无法识别的颜色 {color}，使用白色")
+            r, g, b = 255, 255, 255
+
+    # ASS 的 alpha 为透明度：00 不透明，FF 全透明
+    alpha = int(round((1.0 - max(0.0, min(1.0, opacity))) * 255))
+    return f"&H{alpha:02X}{b:02X}{g:02X}{r:02X}"
+
+
 class VideoOverlayNode:
     """视频画中画合成节点"""
 
@@ -156,67 +1217,333 @@ class VideoOverlayNode:
                     "step": 0.1,
                     "display": "slider",
                 }),
-            }
+            },
+            "optional": {
+                **render_input_types(),
+                "video_fps": ("FLOAT", {
+                    "default": 0.0,  # 0 表示沿用大视频调速后的帧率
+                    "min": 0.0,
+                    "max": 120.0,
+                    "step": 1.0,
+                    "display": "number"
+                }),
+                **graph_input_types(),
+                "background_cache": ("BOOLEAN", {
+                    "default": False,  # 把调速后的大视频缓存为中间文件，之后相同大视频和速度直接读取
+                }),
+            },
         }
     
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("video_path",)
+    RETURN_TYPES = ("STRING", "VIDEO_GRAPH")
+    RETURN_NAMES = ("video_path", "video_graph")
     FUNCTION = "overlay_videos"
     OUTPUT_NODE = True
     CATEGORY = "video"
-    
-    def get_video_info(self, video_path):
-        """获取视频的时长和分辨率"""
+
+    # 参与缓存键计算的输入文件（按指纹而不是路径字符串比较）
+    CACHE_INPUT_KEYS = ("big_video_path", "small_video_path", "mask_video_path")
+    # 输出文件名前缀，后接缓存键
+    OUTPUT_PREFIX = "overlay"
+
+    @classmethod
+    def get_render_key(cls, inputs):
+        """根据输入文件指纹和其余参数计算渲染缓存键"""
+        inputs, graph = pop_graph_inputs(inputs)
+        paths = [inputs[k] for k in cls.CACHE_INPUT_KEYS if inputs.get(k)]
+        params = {k: v for k, v in inputs.items() if k not in cls.CACHE_INPUT_KEYS + RENDER_KEY_IGNORED_INPUTS}
+        if graph is not None:
+            params["big_video_graph"] = graph.render_key
+        params["node"] = cls.__name__
+        return compute_cache_key(paths, params)
+
+    @classmethod
+    def get_video_key(cls, inputs):
+        """画面缓存键：去掉只影响音频的输入"""
+        return cls.get_render_key({k: v for k, v in inputs.items() if k not in AUDIO_INPUT_KEYS})
+
+    @classmethod
+    def get_output_path(cls, render_key):
+        """渲染缓存键对应的输出文件路径"""
+        return os.path.join(folder_paths.get_output_directory(), f"{cls.OUTPUT_PREFIX}_{render_key[:16]}.mp4")
+
+    @classmethod
+    def get_cache_state(cls, inputs):
+        """IS_CHANGED 的返回值：渲染缓存键 + 输出文件是否存在
+
+        输出被缓存淘汰或手动删除后返回值随之变化，ComfyUI 会重新执行节点，而不是把不存在的路径传给下游。
+        """
+        render_key = cls.get_render_key(inputs)
+        return f"{render_key}|{os.path.isfile(cls.get_output_path(render_key))}"
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
         try:
-            probe = ffmpeg.probe(video_path)
-            video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-            
-            width = int(video_info['width'])
-            height = int(video_info['height'])
-            duration = float(probe['format']['duration'])
-            
-            return width, height, duration
-        except Exception as e:
-            raise ValueError(f"无法读取视频信息: {video_path}\n错误: {e}")
+            return cls.get_cache_state(kwargs)
+        except OSError:
+            # 文件不存在时总是重新执行，由节点本身报错
+            return float("nan")
     
     def get_overlay_position(self, position, big_w, big_h, overlay_w, overlay_h, margin_x, margin_y):
-        """根据位置参数计算overlay的x, y坐标"""
+        """根据位置参数计算overlay的x, y坐标（像素）"""
         positions = {
-            "right_bottom": (f"main_w-overlay_w-{margin_x}", f"main_h-overlay_h-{margin_y}"),
-            "right_top": (f"main_w-overlay_w-{margin_x}", str(margin_y)),
-            "left_bottom": (str(margin_x), f"main_h-overlay_h-{margin_y}"),
-            "left_top": (str(margin_x), str(margin_y)),
-            "center": ("(main_w-overlay_w)/2", "(main_h-overlay_h)/2"),
+            "right_bottom": (big_w - overlay_w - margin_x, big_h - overlay_h - margin_y),
+            "right_top": (big_w - overlay_w - margin_x, margin_y),
+            "left_bottom": (margin_x, big_h - overlay_h - margin_y),
+            "left_top": (margin_x, margin_y),
+            "center": ((big_w - overlay_w) // 2, (big_h - overlay_h) // 2),
         }
         return positions.get(position, positions["right_bottom"])
     
-    def overlay_videos(self, big_video_path, small_video_path, mask_video_path,
-                      opacity, position, margin_x, margin_y, size_ratio,
-                      big_video_audio_volume, small_video_audio_volume,
-                      big_video_speed, small_video_speed):
-        """执行视频合成"""
-        
-        # 检查文件是否存在
-        for path in [big_video_path, small_video_path, mask_video_path]:
-            if not os.path.exists(path):
-                raise FileNotFoundError(f"文件不存在: {path}")
-        
+    def scale_video(self, stream, width, height, encoding, **kwargs):
+        """按编码档位的缩放算法缩放视频流"""
+        return ffmpeg.filter(stream, 'scale', width, height, flags=encoding["scale_flags"], **kwargs)
+
+    def choose_loop_mode(self, big_info, big_dur, big_dur_adjusted, frame_w, frame_h):
+        """选择循环大视频的方式
+
+        - "filter": loop/aloop 滤镜把整段解码结果放在内存里，省去重复解码，只用于足够小的视频
+        - "stream_loop": 输入级 -stream_loop，每一轮重新解码，内存占用恒定
+        返回 (模式, 视频帧数, 音频采样数)
+        """
+        nb_frames = int(math.ceil(big_dur * big_info["fps"])) + 1
+        nb_samples = int(math.ceil(big_dur_adjusted * big_info["audio_sample_rate"])) + 1
+        # 保守估计：每像素 3 字节（覆盖 yuv444 / 10bit 等格式），音频按 float 采样
+        video_bytes = nb_frames * frame_w * frame_h * 3
+        audio_bytes = nb_samples * max(1, big_info["audio_channels"]) * 4
+        if video_bytes + audio_bytes <= LOOP_FILTER_MAX_BYTES:
+            return "filter", nb_frames, nb_samples
+        return "stream_loop", nb_frames, nb_samples
+
+    def build_masked_layer(self, small_video, mask_video, target_width, target_height, opacity, encoding,
+                           crop=None):
+        """小视频 + mask → 带alpha通道、已缩放到目标尺寸的叠加层
+
+        mask_video 为 None 时直接使用小视频自带的 alpha 通道，省去 mask 的解码和缩放。
+        crop 为 (x, y, w, h) 时先把小视频和 mask 裁剪到 mask 的非零区域，再缩放到目标尺寸。
+        始终精确缩放到 target_width x target_height（宽度已按小视频比例计算，误差不到 1 像素），
+        plan_overlay 预先算好的叠加坐标才能正好贴边。
+        """
+        if crop:
+            small_video = ffmpeg.filter(small_video, 'crop', *crop[2:], *crop[:2])
+            if mask_video is not None:
+                mask_video = ffmpeg.filter(mask_video, 'crop', *crop[2:], *crop[:2])
+
+        if mask_video is None:
+            layer = self.scale_video(
+                small_video,
+                target_width,
+                target_height,
+                encoding
+            )
+            # 应用透明度到alpha通道
+            if opacity < 1.0:
+                layer = ffmpeg.filter(layer, 'format', 'yuva420p')
+                layer = ffmpeg.filter(layer, 'lutyuv', a=f'val*{opacity}')
+            return layer
+
+        # 处理mask
+        mask_gray = ffmpeg.filter(mask_video, 'format', 'gray')
+
+        # 缩放
+        small_scaled = self.scale_video(
+            small_video,
+            target_width,
+            target_height,
+            encoding
+        )
+        mask_scaled = self.scale_video(
+            mask_gray,
+            target_width,
+            target_height,
+            encoding
+        )
+
+        # 应用透明度到mask
+        if opacity < 1.0:
+            mask_scaled = ffmpeg.filter(
+                mask_scaled,
+                'colorlevels',
+                romax=opacity
+            )
+
+        # 合并alpha通道
+        return ffmpeg.filter(
+            [small_scaled, mask_scaled],
+            'alphamerge'
+        )
+
+    def plan_mask_crop(self, analysis, small_info, mask_video_path):
+        """根据 mask 分析结果返回裁剪区域 (x, y, w, h)，不值得裁剪时返回 None"""
+        small_w, small_h = small_info["width"], small_info["height"]
+        if mask_video_path:
+            mask_info = get_media_info(mask_video_path)
+            if (mask_info["width"], mask_info["height"]) != (small_w, small_h):
+                print(f"[VideoOverlay] mask与小视频分辨率不同，跳过mask范围裁剪")
+                return None
+
+        if analysis["bbox"] is None:
+            return None
+        # 对齐到偶数像素，满足 yuv420p 的色度采样
+        x, y, w, h = analysis["bbox"]
+        x0, y0 = x // 2 * 2, y // 2 * 2
+        x1 = min(small_w, (x + w + 1) // 2 * 2)
+        y1 = min(small_h, (y + h + 1) // 2 * 2)
+        if (x1 - x0) * (y1 - y0) > small_w * small_h * MASK_CROP_MAX_AREA:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    def plan_active_intervals(self, analysis, small_trim, small_info, small_video_speed, layer_window, max_dur):
+        """把 mask 非空区间换算到输出时间轴并限制在画中画窗口内
+
+        analysis 为 None 时整个窗口都合成；返回 None 表示始终合成，空列表表示完全不需要合成
+        """
+        layer_start, layer_end = layer_window
+        trim_in, trim_out = small_trim
+        small_end = layer_start + (trim_out - trim_in) / small_video_speed
+        if analysis is None:
+            intervals = [[layer_start, layer_end]]
+        else:
+            intervals = [
+                [layer_start + (max(a, trim_in) - trim_in) / small_video_speed,
+                 layer_start + (min(b, trim_out) - trim_in) / small_video_speed]
+                for a, b in analysis["active"]
+                if b > trim_in and a < trim_out
+            ]
+            # 小视频结束后一直重复最后一帧；设了出点时看出点前最后一帧是否非空
+            if trim_out < small_info["duration"]:
+                last_frame_time = trim_out - 0.5 / small_info["fps"]
+                ends_active = any(a <= last_frame_time < b for a, b in analysis["active"])
+            else:
+                ends_active = analysis["ends_active"]
+            if intervals and ends_active and layer_end > small_end:
+                intervals[-1][1] = layer_end
+        intervals = [[start, min(end, layer_end)] for start, end in intervals if start < layer_end]
+
+        # 很短的空隙不值得切换
+        merged = []
+        for start, end in intervals:
+            if merged and start - merged[-1][1] < MASK_MIN_GAP_SECONDS:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        # 窗口覆盖整条时间轴时才可以不用 enable
+        if len(merged) > MASK_MAX_INTERVALS:
+            merged = [[layer_start, layer_end]]
+        active_dur = sum(min(end, max_dur) - start for start, end in merged)
+        full_window = layer_start <= 0 and layer_end >= max_dur
+        if full_window and active_dur >= max_dur * MASK_MAX_ACTIVE_RATIO:
+            return None
+        return merged
+
+    def get_enable_expr(self, intervals, window_start, window_end):
+        """把输出时间轴上的区间裁剪到 [window_start, window_end) 并平移到窗口内，生成 enable/select 表达式
+
+        返回 None 表示窗口内 mask 始终为空
+        """
+        parts = []
+        for start, end in intervals:
+            if end <= window_start or start >= window_end:
+                continue
+            start = max(start, window_start) - window_start
+            end = min(end, window_end) - window_start
+            parts.append(f"between(t,{start:.4f},{end:.4f})")
+        return "+".join(parts) if parts else None
+
+    def resolve_trim(self, duration, start, end, label):
+        """把入点/出点限制在视频时长内，返回 (入点, 出点)；出点为 0 表示到结尾"""
+        start = min(max(0.0, float(start)), duration)
+        end = duration if end <= 0 else min(float(end), duration)
+        if end <= start:
+            raise ValueError(f"{label}的出点({end:.2f}秒)必须晚于入点({start:.2f}秒)")
+        if (start, end) != (0.0, duration):
+            print(f"[VideoOverlay] {label}入点/出点: {start:.2f}秒 ~ {end:.2f}秒")
+        return start, end
+
+    def plan_overlay(self, big_video_path, small_video_path, mask_video_path,
+                     opacity, position, margin_x, margin_y, size_ratio,
+                     big_video_audio_volume, small_video_audio_volume,
+                     big_video_speed, small_video_speed, encoding, mask_analysis=True, video_fps=0,
+                     trim=None, window=None, total_dur=0):
+        """分析输入视频，计算合成所需的尺寸、时长和循环方式
+
+        返回的 plan 字典交给 build_overlay_graph 构建滤镜图；分段并行渲染时同一个 plan 会被多次使用。
+        画布是大视频按输出分辨率和编码档位缩放后的尺寸（draft 档位可能再缩小），小视频尺寸和边距都按画布计算。
+        video_fps 大于 0 时输出固定为该帧率，否则沿用大视频调速后的帧率。
+        trim 为入点/出点字典（big_start, big_end, small_start, small_end，源时间秒，出点 0 表示到结尾），
+        只有入点~出点之间的部分参与合成，其余部分不会被解码。
+        window 为输出时间轴上的画中画显示窗口 (开始, 结束)：小视频从开始时间起播放，结束为 0 表示显示到结尾。
+        total_dur 为多图层合成时整条时间轴的长度（输出至少这么长），各图层的冻结、循环和音频补齐都以它为准。
+        big_video_path 也可以是上游节点的 VideoGraph；需要裁剪或循环大视频时先把它渲染成文件。
+        """
         # 获取视频信息
         print(f"[VideoOverlay] 正在分析视频信息...")
-        big_w, big_h, big_dur = self.get_video_info(big_video_path)
-        small_w, small_h, small_dur = self.get_video_info(small_video_path)
-        
-        print(f"[VideoOverlay] 大视频: {big_w}x{big_h}, {big_dur:.2f}秒")
-        print(f"[VideoOverlay] 小视频: {small_w}x{small_h}, {small_dur:.2f}秒")
-        
+        trim = trim or {}
+        if isinstance(big_video_path, VideoGraph):
+            big_info = big_video_path.info
+            if trim.get("big_start", 0) > 0 or 0 < trim.get("big_end", 0) < big_info["duration"]:
+                big_video_path, big_info = self.materialize_source(big_video_path, "需要裁剪")
+        else:
+            big_info = get_media_info(big_video_path)
+        small_info = get_media_info(small_video_path)
+        big_w, big_h = big_info["width"], big_info["height"]
+        small_w, small_h = small_info["width"], small_info["height"]
+
+        print(f"[VideoOverlay] 大视频: {big_w}x{big_h}, {big_info['duration']:.2f}秒, {big_info['fps']:.2f}fps")
+        print(f"[VideoOverlay] 小视频: {small_w}x{small_h}, {small_info['duration']:.2f}秒, {small_info['fps']:.2f}fps")
+
+        # 入点、出点；之后的时长计算都只针对裁剪后的部分
+        big_trim = self.resolve_trim(big_info["duration"], trim.get("big_start", 0), trim.get("big_end", 0), "大视频")
+        small_trim = self.resolve_trim(
+            small_info["duration"], trim.get("small_start", 0), trim.get("small_end", 0), "小视频"
+        )
+        big_dur = big_trim[1] - big_trim[0]
+        small_dur = small_trim[1] - small_trim[0]
+
+        # 画中画显示窗口；窗口结束后不再需要小视频，出点提前到窗口结束处
+        window_start, window_end = window or (0.0, 0.0)
+        windowed = window_start > 0 or window_end > 0
+        if window_end > 0:
+            if window_end <= window_start:
+                raise ValueError(f"画中画窗口的结束时间({window_end:.2f}秒)必须晚于开始时间({window_start:.2f}秒)")
+            visible_dur = (window_end - window_start) * small_video_speed
+            if visible_dur < small_dur:
+                small_trim = (small_trim[0], small_trim[0] + visible_dur)
+                small_dur = visible_dur
+        if windowed:
+            print(f"[VideoOverlay] 画中画窗口: {window_start:.2f}秒 ~ " + (f"{window_end:.2f}秒" if window_end > 0 else "结尾"))
+
+        # 未提供 mask 时使用小视频自带的 alpha 通道
+        small_input_kwargs = {}
+        if not mask_video_path:
+            if not small_info["has_alpha"]:
+                raise ValueError(f"小视频没有alpha通道（{small_info['pix_fmt']}），请提供 mask_video_path")
+            if small_info["alpha_decoder"]:
+                small_input_kwargs["vcodec"] = small_info["alpha_decoder"]
+            print(f"[VideoOverlay] 使用小视频自带的alpha通道，不加载mask")
+
+        # 画布尺寸：先按输出分辨率缩小，draft 档位再按比例缩小，保持偶数以满足 yuv420p
+        canvas_scale = encoding["downscale"]
+        max_short_side = encoding["max_short_side"]
+        if max_short_side and min(big_w, big_h) > max_short_side:
+            canvas_scale *= max_short_side / min(big_w, big_h)
+        canvas_w = max(2, int(big_w * canvas_scale) // 2 * 2)
+        canvas_h = max(2, int(big_h * canvas_scale) // 2 * 2)
+        if (canvas_w, canvas_h) != (big_w, big_h):
+            print(f"[VideoOverlay] 画布缩放: {big_w}x{big_h} → {canvas_w}x{canvas_h}")
+            margin_x = int(margin_x * canvas_scale)
+            margin_y = int(margin_y * canvas_scale)
+
         # 计算小视频目标尺寸
-        target_height = int(big_h * size_ratio)
+        target_height = int(canvas_h * size_ratio)
         target_width = int(target_height * small_w / small_h)
-        
+
         print(f"[VideoOverlay] 小视频目标尺寸: {target_width}x{target_height}")
         print(f"[VideoOverlay] 透明度: {opacity}, 位置: {position}")
         print(f"[VideoOverlay] 音频混合 - 大视频: {big_video_audio_volume}, 小视频: {small_video_audio_volume}")
         print(f"[VideoOverlay] 视频速度 - 大视频: {big_video_speed}x, 小视频: {small_video_speed}x")
+        if video_fps > 0:
+            print(f"[VideoOverlay] 输出帧率: {video_fps}fps（调速后 {big_info['fps'] * big_video_speed:.2f}fps）")
 
         # 计算调速后的实际时长
         big_dur_adjusted = big_dur / big_video_speed
@@ -224,250 +1551,821 @@ class VideoOverlayNode:
 
         print(f"[VideoOverlay] 调速后时长 - 大视频: {big_dur_adjusted:.2f}秒, 小视频: {small_dur_adjusted:.2f}秒")
 
-        # 计算overlay位置
+        # 计算overlay位置（按完整的小视频画面）
         overlay_x, overlay_y = self.get_overlay_position(
-            position, big_w, big_h, target_width, target_height, margin_x, margin_y
+            position, canvas_w, canvas_h, target_width, target_height, margin_x, margin_y
         )
 
-        # 生成输出文件路径
-        output_dir = folder_paths.get_output_directory()
-        unique_id = str(uuid.uuid4())[:8]
-        output_filename = f"overlay_{unique_id}.mp4"
-        output_path = os.path.join(output_dir, output_filename)
+        # 分析 mask（或小视频自带的 alpha）
+        analysis = None
+        if mask_analysis:
+            if mask_video_path:
+                analysis = analyze_mask(mask_video_path)
+            else:
+                analysis = analyze_mask(small_video_path, from_alpha=True, decoder=small_info["alpha_decoder"])
+
+        # 每帧都相同的 mask 只解码一帧，alphamerge 会一直沿用这一帧
+        mask_still = None
+        if analysis and analysis["static"]:
+            mask_still = get_mask_still(mask_video_path)
+            print(f"[VideoOverlay] mask是静态的，使用单帧mask")
+
+        # 只合成 mask 的非零区域：裁剪后缩放比例不变，叠加位置加上裁剪偏移
+        crop = self.plan_mask_crop(analysis, small_info, mask_video_path) if analysis else None
+        layer_width, layer_height = target_width, target_height
+        if crop:
+            layer_scale = target_height / small_h
+            crop_x, crop_y, crop_w, crop_h = crop
+            layer_width = max(2, int(round(crop_w * layer_scale)))
+            layer_height = max(2, int(round(crop_h * layer_scale)))
+            overlay_x += int(round(crop_x * layer_scale))
+            overlay_y += int(round(crop_y * layer_scale))
+            print(f"[VideoOverlay] 按mask范围裁剪小视频: {crop_w}x{crop_h}+{crop_x}+{crop_y} → {layer_width}x{layer_height}")
+
+        # mask 为空的时间段和窗口之外不合成
+        layer_end = max(window_start + small_dur_adjusted, window_end)
+        max_dur = max(big_dur_adjusted, layer_end, total_dur)
+        layer_window = (window_start, window_end if window_end > 0 else max_dur)
+        active_intervals = None
+        if analysis or windowed:
+            active_intervals = self.plan_active_intervals(
+                analysis, small_trim, small_info, small_video_speed, layer_window, max_dur
+            )
+        if active_intervals is not None:
+            active_dur = sum(min(end, max_dur) - start for start, end in active_intervals)
+            print(f"[VideoOverlay] 需要合成的区间: {len(active_intervals)} 段, 共 {active_dur:.2f}/{max_dur:.2f}秒，其余时间跳过合成")
+
+        # 小视频更长时需要循环大视频，先决定循环方式
+        loop_mode, loop_frames, loop_samples = None, 0, 0
+        if big_dur_adjusted >= max_dur and big_dur_adjusted > layer_end:
+            print(f"[VideoOverlay] 大视频更长，冻结小视频最后一帧")
+        else:
+            if isinstance(big_video_path, VideoGraph):
+                # 视频图只能从头到尾读取一次，不能循环
+                big_video_path, big_info = self.materialize_source(big_video_path, "需要循环")
+                big_trim = (0.0, big_info["duration"])
+                big_dur = big_info["duration"]
+            loop_mode, loop_frames, loop_samples = self.choose_loop_mode(
+                big_info, big_dur, big_dur_adjusted, canvas_w, canvas_h
+            )
+            if loop_mode == "filter":
+                print(f"[VideoOverlay] 小视频更长，循环大视频（视频较小，使用loop滤镜缓存 {loop_frames} 帧）")
+            else:
+                print(f"[VideoOverlay] 小视频更长，循环大视频（-stream_loop，内存占用恒定）")
+
+        return {
+            "big_video_path": big_video_path,
+            "small_video_path": small_video_path,
+            "mask_video_path": mask_video_path,
+            "big_trim": big_trim,
+            "big_trimmed": big_trim != (0.0, big_info["duration"]),
+            "small_trim": small_trim,
+            "mask_still": mask_still,
+            "small_input_kwargs": small_input_kwargs,
+            "big_info": big_info,
+            "small_info": small_info,
+            "canvas_w": canvas_w,
+            "canvas_h": canvas_h,
+            "canvas_scale": canvas_scale,
+            "target_width": target_width,
+            "target_height": target_height,
+            "crop": crop,
+            "layer_width": layer_width,
+            "layer_height": layer_height,
+            "overlay_x": overlay_x,
+            "overlay_y": overlay_y,
+            "opacity": opacity,
+            "big_video_audio_volume": big_video_audio_volume,
+            "small_video_audio_volume": small_video_audio_volume,
+            "big_video_speed": big_video_speed,
+            "small_video_speed": small_video_speed,
+            "big_dur_adjusted": big_dur_adjusted,
+            "small_dur_adjusted": small_dur_adjusted,
+            "max_dur": max_dur,
+            "output_fps": video_fps if video_fps > 0 else None,
+            "frame_rate": video_fps if video_fps > 0 else big_info["fps"] * big_video_speed,
+            "active_intervals": active_intervals,
+            "windowed": windowed,
+            "layer_window": layer_window,
+            "pad_dur": max(0.0, max_dur - window_start - small_dur_adjusted),
+            "loop_mode": loop_mode,
+            "loop_frames": loop_frames,
+            "loop_samples": loop_samples,
+            "encoding": encoding,
+        }
+
+    def conform_background(self, big_video_path, speed, output_path):
+        """把大视频按 speed 调速成中间文件（全帧内 x264 + PCM），返回 output_path
+
+        每帧都是关键帧，crf 12 的画质损失在最终编码后可以忽略；ultrafast + fastdecode 解码快，
+        分段渲染时 -ss 可以直接定位到任意一帧
+        """
+        info = get_media_info(big_video_path)
+        fps = info["fps"] * speed
+        print(f"[VideoOverlay] 生成调速后的大视频: {speed}x")
 
-        # 加载输入视频
         big_input = ffmpeg.input(big_video_path)
-        small_input = ffmpeg.input(small_video_path)
-        mask_input = ffmpeg.input(mask_video_path)
+        streams = [ffmpeg.filter(big_input.video, 'setpts', f'{1.0/speed}*PTS')]
+        if info["has_audio"]:
+            streams.append(self.apply_audio_speed(big_input.audio, speed))
+        output_stream = ffmpeg.output(
+            *streams,
+            output_path,
+            vcodec='libx264',
+            preset='ultrafast',
+            tune='fastdecode',
+            crf=BACKGROUND_CRF,
+            g=1,
+            r=fps,
+            acodec='pcm_s16le'
+        )
+        run_ffmpeg(output_stream)
+        return output_path
+
+    def cached_background(self, big_video_path, speed, keep=()):
+        """background_cache：返回持久缓存的已调速大视频，还没有时先生成
 
-        max_dur = max(big_dur_adjusted, small_dur_adjusted)
-        
+        以 源文件指纹 + 速度 为键存放在 cache/backgrounds，总大小超过上限时按最久未使用删除；
+        刚生成的文件和 keep 中的文件（同一批次还要使用的其他速度）不会被删除。
+        """
+        key = compute_cache_key([big_video_path], {"speed": speed, "version": BACKGROUND_CACHE_VERSION})
+        output_path = os.path.join(BACKGROUND_CACHE_DIR, f"background_{key[:16]}.mkv")
+        if lookup_render_cache(output_path):
+            print(f"[VideoOverlay] ✓ 命中调速缓存: {os.path.basename(output_path)}（{speed}x）")
+            return output_path
+
+        os.makedirs(BACKGROUND_CACHE_DIR, exist_ok=True)
+        partial_path = f"{output_path}.{str(uuid.uuid4())[:8]}.partial.mkv"
         try:
-            if big_dur_adjusted > small_dur_adjusted:
-                print(f"[VideoOverlay] 大视频更长，冻结小视频最后一帧")
-                pad_dur = big_dur_adjusted - small_dur_adjusted
-
-                # 应用调速到大视频
-                big_video = big_input.video
-                if big_video_speed != 1.0:
-                    big_video = ffmpeg.filter(big_video, 'setpts', f'{1.0/big_video_speed}*PTS')
-
-                # 应用调速到小视频
-                small_video = small_input.video
-                if small_video_speed != 1.0:
-                    small_video = ffmpeg.filter(small_video, 'setpts', f'{1.0/small_video_speed}*PTS')
-
-                # 延长小视频
-                small_padded = ffmpeg.filter(
-                    small_video,
-                    'tpad',
-                    stop_mode='clone',
-                    stop_duration=pad_dur
-                )
+            self.conform_background(big_video_path, speed, partial_path)
+            os.replace(partial_path, output_path)
+        except ffmpeg.Error as e:
+            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+            print(f"[VideoOverlay] ✗ FFmpeg错误:\n{error_msg}")
+            raise RuntimeError(f"大视频调速失败: {error_msg}")
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        evict_render_cache(
+            BACKGROUND_CACHE_DIR, BACKGROUND_CACHE_MAX_BYTES, BACKGROUND_CACHE_PATTERN, keep=[output_path, *keep]
+        )
+        return output_path
 
-                # 应用调速到mask（与小视频同步）
-                mask_video = mask_input.video
-                if small_video_speed != 1.0:
-                    mask_video = ffmpeg.filter(mask_video, 'setpts', f'{1.0/small_video_speed}*PTS')
+    def apply_background(self, background, big_video_speed, trim):
+        """用已调速的中间文件 background=(路径, 速度) 代替大视频，返回 (路径, 剩余的速度)
 
-                # 延长mask
-                mask_padded = ffmpeg.filter(
-                    mask_video,
-                    'tpad',
-                    stop_mode='clone',
-                    stop_duration=pad_dur
-                )
-                mask_gray = ffmpeg.filter(mask_padded, 'format', 'gray')
-                
-                # 缩放
-                small_scaled = ffmpeg.filter(
-                    small_padded,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                mask_scaled = ffmpeg.filter(
-                    mask_gray,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                
-                # 应用透明度到mask
-                if opacity < 1.0:
-                    mask_scaled = ffmpeg.filter(
-                        mask_scaled,
-                        'colorlevels',
-                        romax=opacity
-                    )
-                
-                # 合并alpha通道
-                small_masked = ffmpeg.filter(
-                    [small_scaled, mask_scaled],
-                    'alphamerge'
-                )
-
-                # overlay
-                video_out = ffmpeg.overlay(
-                    big_video,
-                    small_masked,
-                    x=overlay_x,
-                    y=overlay_y,
-                    format='auto'
+        trim 中大视频的入点/出点（源时间）原地换算为中间文件里的时间。
+        """
+        path, speed = background
+        speed_ratio = big_video_speed / speed
+        trim["big_start"] /= speed_ratio
+        trim["big_end"] /= speed_ratio
+        return path, speed
+
+    def materialize_source(self, graph, reason):
+        """把作为大视频的上游视频图渲染成文件，返回 (路径, 视频信息)"""
+        print(f"[VideoOverlay] 大视频{reason}，先渲染上游视频图")
+        path = graph.render()
+        return path, get_media_info(path)
+
+    def build_overlay_graph(self, plan, segment=None, layer_plans=None):
+        """根据 plan 构建画中画合成的滤镜图，返回 (video_out, audio_out)
+
+        segment 为 (起始秒, 时长) 时只构建输出时间轴上的这一段：
+        各输入用输入级 -ss 定位到对应的源时间（考虑调速、循环和冻结），输出时间戳从 0 开始。
+        layer_plans 为多图层合成时各图层的 plan（从下到上，与 plan 共用大视频和时间轴），默认只有 plan 一个图层。
+        """
+        start = segment[0] if segment else 0.0
+        end = start + segment[1] if segment else plan["max_dur"]
+        layer_plans = layer_plans or [plan]
+
+        # 大视频只解码一次，各图层依次叠加在上面
+        audio_plan = self.plan_audio(plan, layer_plans)
+        video_out, big_audio_source, loop_mode = self.build_background(
+            plan, start, end, segment, with_audio=not segment and audio_plan["big"]
+        )
+        # 多个图层（包括上游视频图中的图层）使用同一个文件时，给每个图层的滤镜链加上不同的标记，避免被合并成一个
+        source = plan["big_video_path"]
+        stage = source.depth if isinstance(source, VideoGraph) else 0
+        layer_audios = []
+        for idx, layer_plan in enumerate(layer_plans):
+            tag = stage * 1000 + idx if len(layer_plans) > 1 or stage > 0 else None
+            video_out, small_input, small_delay = self.build_layer(layer_plan, video_out, start, end, tag)
+            layer_audios.append((layer_plan, small_input, small_delay, tag))
+
+        if segment:
+            # 分段只渲染视频，音频由整条时间轴单独渲染一次
+            return video_out, None
+        if audio_plan["copy"]:
+            # 唯一的音频原样使用，输出时直接复制
+            if audio_plan["big"]:
+                return video_out, big_audio_source
+            return video_out, layer_audios[audio_plan["layers"].index(True)][1].audio
+
+        # 音频处理：只解码和混合实际需要的音频（没有音频流或音量为 0 的输入不参与）
+        audible = []
+        if audio_plan["big"]:
+            # 大视频音频调速（小视频更长时需要循环）
+            big_video_speed = plan["big_video_speed"]
+            big_audio = big_audio_source
+            if big_video_speed != 1.0:
+                big_audio = self.apply_audio_speed(big_audio, big_video_speed)
+            if loop_mode == "filter":
+                big_audio = ffmpeg.filter(
+                    big_audio,
+                    'aloop',
+                    loop=-1,
+                    size=plan["loop_samples"]  # 整段音频的采样数
                 )
-                
-                # 音频处理：混合两个音频
-                # 大视频音频调速
-                big_audio = big_input.audio
-                if big_video_speed != 1.0:
-                    big_audio = self.apply_audio_speed(big_audio, big_video_speed)
-                big_audio = ffmpeg.filter(big_audio, 'volume', big_video_audio_volume)
-
-                # 小视频音频调速后需要延长（冻结静音）
-                small_audio = small_input.audio
-                if small_video_speed != 1.0:
-                    small_audio = self.apply_audio_speed(small_audio, small_video_speed)
-                small_audio = ffmpeg.filter(small_audio, 'volume', small_video_audio_volume)
-                small_audio_padded = ffmpeg.filter(
+            if plan["big_video_audio_volume"] != 1.0:
+                big_audio = ffmpeg.filter(big_audio, 'volume', plan["big_video_audio_volume"])
+            audible.append(big_audio)
+
+        # 小视频音频调速（大视频更长时需要延长静音）
+        for (layer_plan, small_input, small_delay, tag), used in zip(layer_audios, audio_plan["layers"]):
+            if not used:
+                continue
+            small_video_speed = layer_plan["small_video_speed"]
+            small_audio = small_input.audio
+            small_audio = self.tag_stream(small_audio, tag, 'asetpts')
+            if small_video_speed != 1.0:
+                small_audio = self.apply_audio_speed(small_audio, small_video_speed)
+            if layer_plan["small_video_audio_volume"] != 1.0:
+                small_audio = ffmpeg.filter(small_audio, 'volume', layer_plan["small_video_audio_volume"])
+            if small_delay > 0:
+                small_audio = ffmpeg.filter(small_audio, 'adelay', delays=int(round(small_delay * 1000)), all=1)
+            if layer_plan["pad_dur"] > 0:
+                small_audio = ffmpeg.filter(
                     small_audio,
                     'apad',
-                    pad_dur=pad_dur
+                    pad_dur=layer_plan["pad_dur"]
                 )
-                
-                # 混合音频
-                if big_video_audio_volume > 0 and small_video_audio_volume > 0:
-                    audio_out = ffmpeg.filter([big_audio, small_audio_padded], 'amix', inputs=2, duration='longest')
-                elif big_video_audio_volume > 0:
-                    audio_out = big_audio
-                elif small_video_audio_volume > 0:
-                    audio_out = small_audio_padded
-                else:
-                    # 两个音量都是0，使用静音
-                    audio_out = ffmpeg.filter(big_audio, 'volume', 0)
-                
+            audible.append(small_audio)
+
+        # 混合音频；全部静音时输出不带音频
+        if len(audible) > 1:
+            audio_out = ffmpeg.filter(audible, 'amix', inputs=len(audible), duration='longest')
+        elif audible:
+            audio_out = audible[0]
+        else:
+            audio_out = None
+
+        return video_out, audio_out
+
+    def plan_audio(self, plan, layer_plans=None):
+        """根据探测结果和音量规划音频
+
+        返回 {"big": 是否使用大视频的音频, "layers": [各图层是否使用小视频的音频], "audible": 输出是否有音频,
+        "copy": 唯一使用的音频是否可以直接复制}。没有音频流或音量为 0 的输入不会被解码；
+        只有一路音频且不需要调速、调音量、裁剪、循环、推迟和补齐静音时直接复制，不解码也不重新编码。
+        """
+        layer_plans = layer_plans or [plan]
+        big = plan["big_info"]["has_audio"] and plan["big_video_audio_volume"] > 0
+        layers = [
+            layer_plan["small_info"]["has_audio"] and layer_plan["small_video_audio_volume"] > 0
+            for layer_plan in layer_plans
+        ]
+        copy = False
+        if big and not any(layers):
+            big_info = plan["big_info"]
+            copy = (
+                plan["big_video_speed"] == 1.0 and plan["big_video_audio_volume"] == 1.0
+                and not plan["big_trimmed"] and not plan["loop_mode"]
+                and not isinstance(plan["big_video_path"], VideoGraph)
+                and big_info["audio_codec"] in STREAM_COPY_AUDIO_CODECS
+            )
+        elif not big and len(layer_plans) == 1 and layers[0]:
+            # 多图层时小视频音频带有区分图层的标记滤镜，不能直接复制
+            small_info = plan["small_info"]
+            copy = (
+                plan["small_video_speed"] == 1.0 and plan["small_video_audio_volume"] == 1.0
+                and plan["small_trim"] == (0.0, small_info["duration"]) and plan["layer_window"][0] == 0
+                # 小视频比输出短时需要 apad 补齐静音，直接复制的音频会提前结束
+                and plan["pad_dur"] <= 0
+                and not isinstance(plan["big_video_path"], VideoGraph)
+                and small_info["audio_codec"] in STREAM_COPY_AUDIO_CODECS
+            )
+        return {"big": big, "layers": layers, "audible": big or any(layers), "copy": copy}
+
+    def get_audio_codec(self, plan, layer_plans=None):
+        """输出音频的编码器：可以直接复制时为 'copy'，否则重新编码为 AAC"""
+        return 'copy' if self.plan_audio(plan, layer_plans)["copy"] else 'aac'
+
+    def build_background(self, plan, start, end, segment=None, with_audio=True):
+        """加载大视频并处理裁剪、循环、调速、帧率和画布缩放，返回 (视频流, 音频源, 循环方式)
+
+        with_audio 为 False 时不需要大视频的音频（拼接循环片段时不拼接音频）。
+        """
+        encoding = plan["encoding"]
+        big_info = plan["big_info"]
+        big_video_speed = plan["big_video_speed"]
+        canvas_w, canvas_h = plan["canvas_w"], plan["canvas_h"]
+
+        # 分段渲染时 loop 滤镜只能从段首开始缓存，统一改用 -stream_loop
+        loop_mode = plan["loop_mode"]
+        if segment and loop_mode == "filter":
+            loop_mode = "stream_loop"
+
+        # 加载大视频，段起点换算成入点之后的源时间（循环时取模）
+        big_in, big_out = plan["big_trim"]
+        big_trim_dur = big_out - big_in
+        big_offset = start * big_video_speed
+        source = plan["big_video_path"]
+        if isinstance(source, VideoGraph):
+            # 上游视频图直接接入滤镜图（plan_overlay 保证不需要裁剪和循环），分段时只构建上游对应的一段
+            big_video, big_audio_source = source.build(
+                (big_offset, (end - start) * big_video_speed) if segment else None
+            )
+        elif loop_mode == "stream_loop" and plan["big_trimmed"]:
+            # 裁剪过的片段不能用 -stream_loop 循环（每轮都会回到文件开头），
+            # 改为拼接若干个只读取入点~出点的输入
+            pieces = []
+            position = big_offset % big_trim_dur
+            remaining = (end - start) * big_video_speed
+            while remaining > 1e-6:
+                length = min(big_trim_dur - position, remaining)
+                # 参数完全相同的输入会被 ffmpeg-python 合并为一个，一个解码器同时供给 concat 的多个输入时，
+                # 后面各段的帧会在 concat 读完前一段之前全部积压在内存里；每段的队列长度不同，保证各自独立解复用
+                pieces.append(ffmpeg.input(
+                    plan["big_video_path"], ss=big_in + position, t=length,
+                    thread_queue_size=LOOP_PIECE_QUEUE_SIZE + len(pieces)
+                ))
+                remaining -= length
+                position = 0.0
+            print(f"[VideoOverlay] 拼接 {len(pieces)} 段裁剪后的大视频实现循环")
+            if len(pieces) == 1:
+                big_video, big_audio_source = pieces[0].video, pieces[0].audio
+            elif segment or not with_audio:
+                # 分段或不使用大视频音频时只需要视频
+                big_video = ffmpeg.concat(*[piece.video for piece in pieces], v=1, a=0)
+                big_audio_source = None
             else:
-                print(f"[VideoOverlay] 小视频更长，循环大视频")
+                joined = ffmpeg.concat(
+                    *[stream for piece in pieces for stream in (piece.video, piece.audio)], v=1, a=1
+                ).node
+                big_video, big_audio_source = joined[0], joined[1]
+        else:
+            big_kwargs = {}
+            if loop_mode == "stream_loop":
+                # 输入级循环：解复用器读到结尾后从头再读，时间戳连续递增
+                big_kwargs["stream_loop"] = -1
+                big_offset %= big_trim_dur
+            elif loop_mode == "filter":
+                # loop 滤镜缓存入点~出点之间的全部帧
+                big_offset = 0.0
+            if big_in + big_offset > 0:
+                big_kwargs["ss"] = big_in + big_offset
+            if plan["big_trimmed"] and loop_mode != "stream_loop":
+                big_kwargs["t"] = big_trim_dur - big_offset
+            big_input = ffmpeg.input(plan["big_video_path"], **big_kwargs)
+            big_video, big_audio_source = big_input.video, big_input.audio
+
+        # 缩放到画布尺寸：loop 滤镜缓存的是缩放后的帧，所以循环时先缩放；
+        # 否则先按输出帧率丢帧再缩放，被丢掉的帧不用缩放
+        needs_scale = (canvas_w, canvas_h) != (big_info["width"], big_info["height"])
+        if needs_scale and loop_mode == "filter":
+            big_video = self.scale_video(big_video, canvas_w, canvas_h, encoding)
+
+        if loop_mode == "filter":
+            # 循环大视频，缓存大小正好是整段视频的帧数
+            # 注意 loop 必须放在 setpts 之前，否则循环帧的时间戳不会前进
+            big_video = ffmpeg.filter(
+                big_video,
+                'loop',
+                loop=-1,
+                size=plan["loop_frames"],
+                start=0
+            )
 
-                # 应用调速到大视频
-                big_video = big_input.video
-                if big_video_speed != 1.0:
-                    big_video = ffmpeg.filter(big_video, 'setpts', f'{1.0/big_video_speed}*PTS')
+        # 应用调速到大视频
+        if big_video_speed != 1.0:
+            big_video = ffmpeg.filter(big_video, 'setpts', f'{1.0/big_video_speed}*PTS')
 
-                # 循环大视频
-                big_loop = ffmpeg.filter(
-                    big_video,
-                    'loop',
-                    loop=-1,
-                    size=32767,
-                    start=0
-                )
+        # 输出帧率：调速后立即丢帧（或补帧），之后的缩放、合成、字幕和编码都只处理输出帧
+        if plan["output_fps"]:
+            big_video = ffmpeg.filter(big_video, 'fps', plan["output_fps"])
+        if needs_scale and loop_mode != "filter":
+            big_video = self.scale_video(big_video, canvas_w, canvas_h, encoding)
+
+        return big_video, big_audio_source, loop_mode
 
-                # 应用调速到小视频
-                small_video = small_input.video
-                if small_video_speed != 1.0:
-                    small_video = ffmpeg.filter(small_video, 'setpts', f'{1.0/small_video_speed}*PTS')
+    def build_layer(self, plan, big_video, start, end, tag=None):
+        """把 plan 描述的小视频图层叠加到 big_video 上，返回 (视频流, 小视频输入, 推迟的秒数)
 
-                # 应用调速到mask（与小视频同步）
-                mask_video = mask_input.video
-                if small_video_speed != 1.0:
+        小视频输入只在从头渲染整条时间轴时用于音频，冻结区间内为 None。
+        tag 为图层序号，不为空时在小视频和 mask 的输入后插入按序号区分的空操作滤镜（见 tag_stream）。
+        """
+        encoding = plan["encoding"]
+        small_info = plan["small_info"]
+        small_video_speed = plan["small_video_speed"]
+        output_fps = plan["output_fps"]
+
+        # 只在 mask 非空的区间合成：overlay 用 enable 直接透传大视频，小视频和 mask 用 select 丢弃其余帧
+        active_expr = None
+        if plan["active_intervals"] is not None:
+            active_expr = self.get_enable_expr(plan["active_intervals"], start, end)
+        skip_layer = plan["active_intervals"] is not None and active_expr is None
+
+        # 加载小视频和mask
+        # 没有 mask 时 mask_video 为 None，使用小视频自带的 alpha 通道；
+        # 静态 mask 使用单帧图片，与时间无关，不需要定位和调速
+        mask_path = plan["mask_video_path"]
+        mask_still = plan["mask_still"]
+        small_in, small_out = plan["small_trim"]
+        # 小视频从画中画窗口开始时播放：段首在窗口之前时推迟，之后则定位到对应的源时间
+        layer_start = plan["layer_window"][0]
+        small_delay = max(0.0, layer_start - start)
+        small_offset = max(0.0, start - layer_start) * small_video_speed
+        if small_offset < small_out - small_in:
+            # 小视频和 mask 用相同的入点、出点
+            seek_kwargs = {}
+            if small_in + small_offset > 0:
+                seek_kwargs["ss"] = small_in + small_offset
+            if small_out < small_info["duration"]:
+                seek_kwargs["t"] = small_out - small_in - small_offset
+            small_input = ffmpeg.input(plan["small_video_path"], **seek_kwargs, **plan["small_input_kwargs"])
+            small_video = small_input.video
+            mask_video = None
+            if mask_still:
+                mask_video = ffmpeg.input(mask_still).video
+            elif mask_path:
+                mask_video = ffmpeg.input(mask_path, **seek_kwargs).video
+            small_video = self.tag_stream(small_video, tag)
+            if mask_video is not None:
+                mask_video = self.tag_stream(mask_video, tag)
+
+            # 应用调速到小视频和mask（保持同步）
+            if small_video_speed != 1.0:
+                small_video = ffmpeg.filter(small_video, 'setpts', f'{1.0/small_video_speed}*PTS')
+                if mask_video is not None and not mask_still:
                     mask_video = ffmpeg.filter(mask_video, 'setpts', f'{1.0/small_video_speed}*PTS')
 
-                # 处理mask
-                mask_gray = ffmpeg.filter(mask_video, 'format', 'gray')
+            # 小视频帧率高于输出帧率时同样提前丢帧（低于时不补帧，overlay 会沿用上一帧）
+            if output_fps and small_info["fps"] * small_video_speed > output_fps:
+                small_video = ffmpeg.filter(small_video, 'fps', output_fps)
+                if mask_video is not None and not mask_still:
+                    mask_video = ffmpeg.filter(mask_video, 'fps', output_fps)
+
+            if small_delay > 0:
+                small_video = ffmpeg.filter(small_video, 'setpts', f'PTS+{small_delay}/TB')
+                if mask_video is not None and not mask_still:
+                    mask_video = ffmpeg.filter(mask_video, 'setpts', f'PTS+{small_delay}/TB')
+
+            # 调速（和推迟）后的时间戳就是输出时间
+            if active_expr:
+                small_video = ffmpeg.filter(small_video, 'select', active_expr)
+                if mask_video is not None and not mask_still:
+                    mask_video = ffmpeg.filter(mask_video, 'select', active_expr)
+        else:
+            # 整段都处于冻结区间：只取小视频最后一帧，由 overlay 一直重复
+            small_input = None
+            small_video = self.last_frame(plan["small_video_path"], small_out, tag, **plan["small_input_kwargs"])
+            mask_video = None
+            if mask_still:
+                mask_video = self.tag_stream(ffmpeg.input(mask_still).video, tag)
+            elif mask_path:
+                mask_video = self.last_frame(mask_path, small_out, tag)
+
+        if skip_layer:
+            # 整个窗口内 mask 都是空的，直接输出大视频
+            return big_video, small_input, small_delay
+
+        # 小视频每个源帧只缩放/合并alpha一次，结束后由 overlay 的 eof_action=repeat 保持最后一帧，
+        # 不再用 tpad 克隆帧，补齐部分几乎没有额外开销
+        small_masked = self.build_masked_layer(
+            small_video, mask_video, plan["layer_width"], plan["layer_height"], plan["opacity"], encoding,
+            plan["crop"]
+        )
 
-                # 缩放
-                small_scaled = ffmpeg.filter(
-                    small_video,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                mask_scaled = ffmpeg.filter(
-                    mask_gray,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                
-                # 应用透明度到mask
-                if opacity < 1.0:
-                    mask_scaled = ffmpeg.filter(
-                        mask_scaled,
-                        'colorlevels',
-                        romax=opacity
-                    )
-                
-                # 合并alpha通道
-                small_masked = ffmpeg.filter(
-                    [small_scaled, mask_scaled],
-                    'alphamerge'
-                )
-                
-                # overlay
-                video_out = ffmpeg.overlay(
-                    big_loop,
-                    small_masked,
-                    x=overlay_x,
-                    y=overlay_y,
-                    format='auto'
-                )
-                
-                # 音频处理：混合两个音频
-                # 大视频音频调速后需要循环
-                big_audio = big_input.audio
-                if big_video_speed != 1.0:
-                    big_audio = self.apply_audio_speed(big_audio, big_video_speed)
-                big_audio_loop = ffmpeg.filter(
-                    big_audio,
-                    'aloop',
-                    loop=-1,
-                    size=2e9  # 足够大的采样数
-                )
-                big_audio = ffmpeg.filter(big_audio_loop, 'volume', big_video_audio_volume)
-
-                # 小视频音频调速
-                small_audio = small_input.audio
-                if small_video_speed != 1.0:
-                    small_audio = self.apply_audio_speed(small_audio, small_video_speed)
-                small_audio = ffmpeg.filter(small_audio, 'volume', small_video_audio_volume)
-                
-                # 混合音频
-                if big_video_audio_volume > 0 and small_video_audio_volume > 0:
-                    audio_out = ffmpeg.filter([big_audio, small_audio], 'amix', inputs=2, duration='longest')
-                elif big_video_audio_volume > 0:
-                    audio_out = big_audio
-                elif small_video_audio_volume > 0:
-                    audio_out = small_audio
-                else:
-                    # 两个音量都是0，使用静音
-                    audio_out = ffmpeg.filter(small_audio, 'volume', 0)
-            
-            # 输出
-            print(f"[VideoOverlay] 开始合成视频...")
+        # overlay（小视频结束后重复最后一帧）
+        overlay_kwargs = {"enable": active_expr} if active_expr else {}
+        video_out = ffmpeg.overlay(
+            big_video,
+            small_masked,
+            x=plan["overlay_x"],
+            y=plan["overlay_y"],
+            eof_action='repeat',
+            format='auto',
+            **overlay_kwargs
+        )
+        return video_out, small_input, small_delay
+
+    def tag_stream(self, stream, tag, filter_name='setpts'):
+        """按图层序号插入一个空操作滤镜（tag 为空时原样返回）
+
+        ffmpeg-python 按滤镜参数和上游节点合并相同的节点（不看滤镜名），多个图层用同一个文件时
+        后续滤镜链会被合并成一个节点、输出多条边而无法编译；参数里带上序号后各图层的链互不相同。
+        """
+        if tag is None:
+            return stream
+        return ffmpeg.filter(stream, filter_name, f'PTS+0*{tag}')
+
+    def last_frame(self, video_path, end_time, tag=None, **input_kwargs):
+        """只解码 end_time（出点）之前的一小段，取出最后一帧（用于冻结区间的分段渲染）"""
+        tail = min(1.0, end_time)
+        if end_time > tail:
+            input_kwargs["ss"] = end_time - tail
+        stream = ffmpeg.input(video_path, t=tail, **input_kwargs).video
+        stream = self.tag_stream(stream, tag)
+        stream = ffmpeg.filter(stream, 'reverse')
+        stream = ffmpeg.filter(stream, 'trim', end_frame=1)
+        return ffmpeg.filter(stream, 'setpts', 'PTS-STARTPTS')
+
+    def split_timeline(self, duration, parallel_segments, frame_rate=None):
+        """把输出时间轴等分为若干段，每段至少 MIN_SEGMENT_SECONDS 秒
+
+        给定 frame_rate 时切点对齐到输出帧边界，避免拼接处重复或丢帧
+        """
+        count = max(1, min(parallel_segments, int(duration // MIN_SEGMENT_SECONDS)))
+        cuts = [duration * i / count for i in range(count)] + [duration]
+        if frame_rate and frame_rate > 0:
+            cuts[1:-1] = [round(t * frame_rate) / frame_rate for t in cuts[1:-1]]
+        return [(cuts[i], cuts[i + 1] - cuts[i]) for i in range(count)]
+
+    def plan_segments(self, plan, parallel_segments, passthrough=None):
+        """需要渲染的段 [(起始秒, 时长), ...]；智能渲染时只切分需要重新编码的区间"""
+        start, end = (passthrough["start"], passthrough["end"]) if passthrough else (0.0, plan["max_dur"])
+        return [
+            (start + offset, duration)
+            for offset, duration in self.split_timeline(end - start, parallel_segments, plan["frame_rate"])
+        ]
+
+    def plan_passthrough(self, plan, layer_plans=None):
+        """智能渲染：画中画窗口之外的画面与大视频完全相同时，只重新编码窗口所在的关键帧区间
+
+        返回 {"path", "start", "end", "head", "tail"}：start~end 为需要渲染的区间（输出时间），
+        head 为 (出点, 时长) 表示复制窗口之前的部分，tail 为入点表示复制窗口之后的部分；不能复制时返回 None。
+        多图层时按所有图层窗口的并集计算。
+        """
+        layer_plans = layer_plans or [plan]
+        if not all(layer_plan["windowed"] for layer_plan in layer_plans):
+            return None
+        if isinstance(plan["big_video_path"], VideoGraph):
+            print(f"[VideoOverlay] 大视频是未渲染的视频图，整段重新编码")
+            return None
+        big_info = plan["big_info"]
+        reasons = []
+        if plan["big_video_speed"] != 1.0 or plan["big_trimmed"] or plan["loop_mode"]:
+            reasons.append("大视频需要调速/裁剪/循环")
+        if (plan["canvas_w"], plan["canvas_h"]) != (big_info["width"], big_info["height"]):
+            reasons.append("画布尺寸不同")
+        if plan["output_fps"] and abs(plan["output_fps"] - big_info["fps"]) > 1e-3:
+            reasons.append("输出帧率不同")
+        if STREAM_COPY_CODECS.get(plan["encoding"]["vcodec"]) != big_info["codec_name"] or big_info["pix_fmt"] != "yuv420p":
+            reasons.append(f"大视频编码({big_info['codec_name']}, {big_info['pix_fmt']})与输出不一致")
+        if reasons:
+            print(f"[VideoOverlay] 无法复制窗口外的画面（{'；'.join(reasons)}），整段重新编码")
+            return None
+
+        # 窗口开始之前最近的关键帧 ~ 窗口结束之后最近的关键帧
+        keyframe_info = get_keyframes(plan["big_video_path"])
+        origin = keyframe_info["start"]
+        keyframes = [(pts - origin, dts - origin) for pts, dts in keyframe_info["keyframes"]]
+        layer_start = min(layer_plan["layer_window"][0] for layer_plan in layer_plans)
+        layer_end = max(layer_plan["layer_window"][1] for layer_plan in layer_plans)
+        frame_dur = 1.0 / big_info["fps"]
+        head = [kf for kf in keyframes if 0 < kf[0] <= layer_start + frame_dur * 0.5]
+        tail = [kf for kf in keyframes if layer_end - frame_dur * 0.5 <= kf[0] < plan["max_dur"] - frame_dur * 0.5]
+        start = head[-1][0] if head else 0.0
+        end = tail[0][0] if tail else plan["max_dur"]
+        if not head and not tail:
+            print(f"[VideoOverlay] 窗口外没有完整的关键帧区间，整段重新编码")
+            return None
+
+        print(f"[VideoOverlay] 智能渲染: 只重新编码 {start:.2f}~{end:.2f}秒，其余 {plan['max_dur'] - end + start:.2f}秒直接复制")
+        return {
+            "path": plan["big_video_path"],
+            "start": start,
+            "end": end,
+            # concat 分离器按 dts 截断：出点取关键帧的 dts，避免关键帧及其后的帧混入；时长保证下一段从关键帧时间开始
+            "head": (head[-1][1] + origin - 1e-4, start) if head else None,
+            "tail": tail[0][0] + origin if tail else None,
+        }
+
+    def render_segments(self, build_segment, audio_out, max_dur, output_path, encoding, segments, progress=None,
+                        passthrough=None, audio_codec='aac'):
+        """分段并行渲染
+
+        - 每段视频由 build_segment(起始秒, 时长) 构建，在线程池中各自启动一个 ffmpeg 进程
+        - 音频按整条时间轴单独渲染一次（避免每段 AAC 首尾的静音间隙）；audio_out 直接来自已编码的文件时可以用 'copy'，
+          为 None 时输出不带音频
+        - 最后用 concat 分离器按流复制拼接各段，并与音频合并，不再重新编码
+        - passthrough（plan_passthrough 的结果）给出时，各段之前/之后直接复制大视频的关键帧区间；
+          重新编码的段与大视频的编码参数（STREAM_SIGNATURE_FIELDS）不一致时不拼接，返回 False 由调用方整段重新编码
+
+        成功写出 output_path 时返回 True
+        """
+        work_dir = os.path.join(
+            folder_paths.get_temp_directory(), f"overlay_segments_{str(uuid.uuid4())[:8]}"
+        )
+        os.makedirs(work_dir, exist_ok=True)
+
+        # 每个编码器分到的线程数，避免 N 个 x264 抢占全部核心
+        segment_encoding = dict(encoding)
+        if segment_encoding["threads"] <= 0:
+            segment_encoding["threads"] = max(1, (os.cpu_count() or 1) // len(segments))
+
+        # (输出, 进度回调)；音频很快，不计入进度
+        jobs = []
+        segment_paths = []
+        for idx, (start, duration) in enumerate(segments):
+            segment_path = os.path.join(work_dir, f"segment_{idx:03d}.mp4")
+            segment_paths.append(segment_path)
+            video = build_segment(start, duration)
+            jobs.append((
+                ffmpeg.output(video, segment_path, t=duration, an=None, **get_output_kwargs(segment_encoding)),
+                progress.callback(idx) if progress else None,
+            ))
+        # mka 可以容纳直接复制的任意音频编码
+        audio_path = os.path.join(work_dir, "audio.mka")
+        if audio_out is not None:
+            jobs.append((ffmpeg.output(audio_out, audio_path, t=max_dur, acodec=audio_codec), None))
+
+        if len(segments) > 1:
+            print(f"[VideoOverlay] 分段并行渲染: {len(segments)} 段, 每段约 {segments[0][1]:.2f}秒")
+        try:
+            with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+                futures = [pool.submit(run_ffmpeg, job, on_progress) for job, on_progress in jobs]
+                for future in futures:
+                    future.result()
+
+            if passthrough:
+                source_info = get_media_info(passthrough["path"])
+                mismatched = sorted({
+                    field
+                    for segment_path in segment_paths
+                    for field, value in get_media_info(segment_path, use_cache=False).items()
+                    if field in STREAM_SIGNATURE_FIELDS and value != source_info[field]
+                })
+                if mismatched:
+                    print(f"[VideoOverlay] 重新编码的区间与大视频的编码参数不一致（{', '.join(mismatched)}），无法无缝拼接，整段重新编码")
+                    return False
+
+            # concat 分离器的文件列表
+            list_path = os.path.join(work_dir, "segments.txt")
+            with open(list_path, "w", encoding="utf-8") as f:
+                if passthrough and passthrough["head"]:
+                    outpoint, duration = passthrough["head"]
+                    f.write(f"file '{os.path.abspath(passthrough['path'])}'\n")
+                    f.write(f"outpoint {outpoint:.6f}\nduration {duration:.6f}\n")
+                for segment_path in segment_paths:
+                    f.write(f"file '{segment_path}'\n")
+                if passthrough and passthrough["tail"] is not None:
+                    f.write(f"file '{os.path.abspath(passthrough['path'])}'\n")
+                    f.write(f"inpoint {passthrough['tail']:.6f}\n")
+
+            concat_input = ffmpeg.input(list_path, f='concat', safe=0)
+            streams = [concat_input.video]
+            if audio_out is not None:
+                streams.append(ffmpeg.input(audio_path).audio)
             output_stream = ffmpeg.output(
-                video_out,
-                audio_out,
+                *streams,
                 output_path,
                 t=max_dur,
-                vcodec='libx264',
-                preset='medium',
-                crf=23,
-                acodec='aac',
-                **{'movflags': '+faststart'}  # 启用流式播放
+                c='copy',
+                movflags='+faststart'
+            )
+            run_ffmpeg(output_stream)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return True
+
+    def build_output(self, plan, segment=None, layer_plans=None):
+        """最终输出的 (视频流, 音频流)：默认就是画中画合成的结果，子类在这里追加处理（如烧录字幕）"""
+        return self.build_overlay_graph(plan, segment, layer_plans)
+
+    def output_result(self, graph, lazy_output=False, show_progress=True):
+        """节点的返回值：lazy_output 时只返回视频图，否则渲染后返回 (文件路径, 视频图)"""
+        if lazy_output and not lookup_render_cache(graph.output_path):
+            print(f"[VideoOverlay] 只输出视频图，由下游节点渲染")
+            return {"result": ("", graph)}
+        output_path = graph.render(show_progress)
+        # 返回相对于output目录的路径，这样ComfyUI可以正确预览
+        return {"ui": {"videos": [graph.output_filename]}, "result": (output_path, graph)}
+
+    def render_plan(self, plan, output_path, encoding, parallel_segments=1, layer_plans=None,
+                    allow_passthrough=True, show_progress=True):
+        """按 plan 构建滤镜图并编码到 output_path：整段渲染、分段并行渲染或智能渲染"""
+        max_dur = plan["max_dur"]
+        passthrough = self.plan_passthrough(plan, layer_plans) if allow_passthrough else None
+        segments = self.plan_segments(plan, parallel_segments, passthrough)
+
+        # 输出
+        print(f"[VideoOverlay] 开始合成视频...")
+        progress = RenderProgress(sum(duration for _, duration in segments)) if show_progress else None
+        if len(segments) > 1 or passthrough:
+            # 各段只渲染视频，音频按整条时间轴单独渲染
+            _, audio_out = self.build_overlay_graph(plan, layer_plans=layer_plans)
+            if not self.render_segments(
+                lambda start, duration: self.build_output(plan, (start, duration), layer_plans)[0],
+                audio_out, max_dur, output_path, encoding, segments, progress, passthrough,
+                self.get_audio_codec(plan, layer_plans)
+            ):
+                self.render_plan(plan, output_path, encoding, parallel_segments, layer_plans, False, show_progress)
+            return
+
+        video_out, audio_out = self.build_output(plan, layer_plans=layer_plans)
+        output_stream = ffmpeg.output(
+            *[stream for stream in (video_out, audio_out) if stream is not None],
+            output_path,
+            t=max_dur,
+            acodec=self.get_audio_codec(plan, layer_plans),
+            **get_output_kwargs(encoding)
+        )
+
+        # 执行
+        run_ffmpeg(output_stream, progress.callback() if progress else None)
+
+    def remux_audio(self, plan, video_path, output_path, layer_plans=None, show_progress=True):
+        """只重新渲染音频（音量/atempo/amix/apad），视频流从画面相同的已有结果直接复制"""
+        max_dur = plan["max_dur"]
+        # 只从音频输出构建滤镜图，视频滤镜链不会进入 ffmpeg 命令
+        _, audio_out = self.build_overlay_graph(plan, layer_plans=layer_plans)
+        progress = RenderProgress(max_dur) if show_progress else None
+        streams = [ffmpeg.input(video_path).video]
+        if audio_out is not None:
+            streams.append(audio_out)
+        output_stream = ffmpeg.output(
+            *streams,
+            output_path,
+            t=max_dur,
+            vcodec='copy',
+            acodec=self.get_audio_codec(plan, layer_plans),
+            movflags='+faststart'
+        )
+        run_ffmpeg(output_stream, progress.callback() if progress else None)
+
+    def overlay_videos(self, big_video_path, small_video_path, mask_video_path,
+                      opacity, position, margin_x, margin_y, size_ratio,
+                      big_video_audio_volume, small_video_audio_volume,
+                      big_video_speed, small_video_speed,
+                      encoding_profile="balanced", encoder_preset="auto", crf=-1,
+                      threads=0, video_codec="auto", draft_downscale=0.5, parallel_segments=1,
+                      mask_analysis=True, output_resolution="source",
+                      big_start=0.0, big_end=0.0, small_start=0.0, small_end=0.0,
+                      overlay_start=0.0, overlay_end=0.0, video_fps=0.0,
+                      big_video_graph=None, lazy_output=False, background_cache=False):
+        """执行视频合成"""
+        render_inputs = dict(locals())
+        del render_inputs["self"]
+        return self.render_overlay(render_inputs)
+
+    def render_overlay(self, render_inputs, background=None, encoding_overrides=None, show_progress=True):
+        """按节点输入渲染一个画中画视频（各合成节点共用的流程，规划由 plan_render 完成）
+
+        background 为 (路径, 速度) 时用它代替原始大视频参与合成（批量节点共享的已调速中间文件），
+        缓存键仍按原始输入计算，与单个节点的渲染结果通用。
+        encoding_overrides 用于覆盖解析出的编码选项（如批量渲染时分配的线程数），不影响缓存键。
+        show_progress 为 False 时不创建进度条（批量节点按条目汇报进度）。
+        连接了 big_video_graph 时用上游视频图代替 big_video_path；开启 background_cache 时使用持久缓存的已调速大视频；
+        lazy_output 时只返回视频图，不渲染。
+        """
+        lazy_output = render_inputs.get("lazy_output", False)
+        for path in self.input_paths(render_inputs):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"文件不存在: {path}")
+
+        # 输入和参数完全相同时直接返回之前的结果
+        render_key = self.get_render_key(render_inputs)
+        output_filename = os.path.basename(self.get_output_path(render_key))
+        cached = VideoGraph(self, render_key, output_filename)
+        if lookup_render_cache(cached.output_path):
+            return self.output_result(cached, lazy_output, show_progress)
+
+        encoding_profile = render_inputs.get("encoding_profile", "balanced")
+        encoding = resolve_encoding_options(
+            encoding_profile,
+            render_inputs.get("encoder_preset", "auto"),
+            render_inputs.get("crf", -1),
+            render_inputs.get("threads", 0),
+            render_inputs.get("video_codec", "auto"),
+            render_inputs.get("draft_downscale", 0.5),
+            render_inputs.get("output_resolution", "source"),
+        )
+        encoding.update(encoding_overrides or {})
+        print(f"[VideoOverlay] 编码档位: {encoding_profile} ({encoding['vcodec']}, preset={encoding['preset']}, crf={encoding['crf']})")
+
+        # 实际参与合成的大视频：上游视频图的渲染结果，或已调速的中间文件
+        big_video_speed = render_inputs["big_video_speed"]
+        big_video = {
+            "big_video_path": render_inputs["big_video_path"],
+            "big_video_speed": big_video_speed,
+            "big_start": render_inputs.get("big_start", 0.0),
+            "big_end": render_inputs.get("big_end", 0.0),
+        }
+        big_video_graph = render_inputs.get("big_video_graph")
+        if big_video_graph is not None:
+            big_video["big_video_path"] = big_video_graph.resolve()
+        elif background is None and render_inputs.get("background_cache") and big_video_speed != 1.0:
+            background = (self.cached_background(render_inputs["big_video_path"], big_video_speed), 1.0)
+        if background:
+            # 中间文件已经调过速，大视频的入点/出点按调速后的时间换算
+            big_video["big_video_path"], big_video["big_video_speed"] = self.apply_background(
+                background, big_video_speed, big_video
             )
-            
-            # 执行
-            ffmpeg.run(output_stream, overwrite_output=True, capture_stderr=True, quiet=True)
-            
-            print(f"[VideoOverlay] ✓ 合成完成: {output_filename}")
-            
-            # 返回相对于output目录的路径，这样ComfyUI可以正确预览
-            return {"ui": {"videos": [output_filename]}, "result": (output_path,)}
-            
+
+        try:
+            plan, layer_plans = self.plan_render(render_inputs, big_video, encoding)
         except ffmpeg.Error as e:
             error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
             print(f"[VideoOverlay] ✗ FFmpeg错误:\n{error_msg}")
@@ -476,36 +2374,513 @@ class VideoOverlayNode:
             print(f"[VideoOverlay] ✗ 处理失败: {e}")
             raise
 
+        # 中间文件已经重新编码过，不能直接复制到输出中
+        graph = VideoGraph(
+            self, render_key, output_filename, plan, layer_plans, encoding,
+            render_inputs.get("parallel_segments", 1), allow_passthrough=background is None,
+            video_key=self.get_video_key(render_inputs)
+        )
+        return self.output_result(graph, lazy_output, show_progress)
+
+    def input_paths(self, render_inputs):
+        """渲染前需要检查是否存在的输入文件（mask 可以留空，此时使用小视频自带的 alpha 通道）"""
+        paths = [render_inputs["small_video_path"]]
+        if render_inputs["mask_video_path"]:
+            paths.append(render_inputs["mask_video_path"])
+        if render_inputs.get("big_video_graph") is None:
+            paths.insert(0, render_inputs["big_video_path"])
+        return paths
+
+    def plan_render(self, render_inputs, big_video, encoding):
+        """规划合成，返回 (plan, layer_plans)
+
+        big_video 为实际参与合成的大视频的 big_video_path/big_video_speed/big_start/big_end，
+        其余参数取自原始的 render_inputs。
+        """
+        trim = {key: render_inputs.get(key, 0.0) for key in TRIM_KEYS}
+        trim.update(big_start=big_video["big_start"], big_end=big_video["big_end"])
+        plan = self.plan_overlay(
+            big_video["big_video_path"], render_inputs["small_video_path"], render_inputs["mask_video_path"],
+            render_inputs["opacity"], render_inputs["position"],
+            render_inputs["margin_x"], render_inputs["margin_y"], render_inputs["size_ratio"],
+            render_inputs["big_video_audio_volume"], render_inputs["small_video_audio_volume"],
+            big_video["big_video_speed"], render_inputs["small_video_speed"], encoding,
+            render_inputs.get("mask_analysis", True), render_inputs.get("video_fps", 0), trim,
+            (render_inputs.get("overlay_start", 0.0), render_inputs.get("overlay_end", 0.0))
+        )
+        return plan, None
 
-class VideoOverlayWithSubtitlesNode:
-    """视频画中画合成节点（带字幕）"""
 
-    def apply_audio_speed(self, audio, speed):
-        """
-        应用音频调速
-        atempo滤镜范围是0.5-2.0，超出范围需要链式调用
-        """
-        if speed == 1.0:
-            return audio
+class VideoOverlayBatchNode(VideoOverlayNode):
+    """批量画中画合成：同一个大视频 + 多组小视频/mask
 
-        # atempo滤镜的有效范围是0.5-2.0
-        # 如果速度超出范围，需要多次应用
-        result = audio
-        remaining_speed = speed
+    - 每个条目是一个 JSON 对象，必须包含 small_video_path；mask_video_path 可省略（使用小视频自带的 alpha），
+      其余字段（opacity、position、size_ratio ...）可选，用于覆盖节点上的默认值
+    - 大视频只分析一次；需要调速时先生成一份已调速的中间文件，所有条目共用
+    - 条目在有上限的线程池中并行渲染，缓存键与单个 VideoOverlayNode 相同，结果可以互相复用
+    """
 
-        while remaining_speed > 2.0:
-            result = ffmpeg.filter(result, 'atempo', 2.0)
-            remaining_speed /= 2.0
+    @classmethod
+    def INPUT_TYPES(cls):
+        base = VideoOverlayNode.INPUT_TYPES()
+        required = {"big_video_path": base["required"]["big_video_path"]}
+        required["entries"] = ("STRING", {
+            "default": '[\n  {"small_video_path": "", "mask_video_path": ""}\n]',
+            "multiline": True,
+        })
+        for key, value in base["required"].items():
+            if key not in cls.CACHE_INPUT_KEYS:
+                required[key] = value
+        required["max_workers"] = ("INT", {
+            "default": 2,
+            "min": 1,
+            "max": 16,
+            "step": 1,
+        })
+        # 各条目分别输出文件，不支持视频图
+        optional = {k: v for k, v in base["optional"].items() if k not in GRAPH_INPUT_KEYS}
+        return {
+            "required": required,
+            "optional": optional,
+        }
 
-        while remaining_speed < 0.5:
-            result = ffmpeg.filter(result, 'atempo', 0.5)
-            remaining_speed /= 0.5
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("video_paths",)
+    OUTPUT_IS_LIST = (True,)
+    FUNCTION = "batch_overlay_videos"
+    OUTPUT_NODE = True
+    CATEGORY = "video"
 
-        if remaining_speed != 1.0:
-            result = ffmpeg.filter(result, 'atempo', remaining_speed)
+    @classmethod
+    def get_render_key(cls, inputs):
+        # 每个条目都按单个 VideoOverlayNode 计算缓存键
+        return VideoOverlayNode.get_render_key(inputs)
 
+    @classmethod
+    def parse_entries(cls, entries, defaults):
+        """解析条目 JSON，返回每个条目完整的节点输入"""
+        try:
+            items = json.loads(entries) if isinstance(entries, str) else entries
+        except json.JSONDecodeError as e:
+            raise ValueError(f"条目不是合法的JSON: {e}")
+        if not isinstance(items, list) or not items:
+            raise ValueError("条目必须是非空的JSON数组")
+
+        result = []
+        for idx, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError(f"第 {idx + 1} 个条目必须是JSON对象")
+            if not item.get("small_video_path"):
+                raise ValueError(f"第 {idx + 1} 个条目缺少 small_video_path")
+            # 条目共用同一个大视频，不允许单独指定
+            allowed = (set(defaults) - {"big_video_path"}) | {"small_video_path", "mask_video_path"}
+            unknown = set(item) - allowed
+            if unknown:
+                raise ValueError(f"第 {idx + 1} 个条目包含不支持的字段: {', '.join(sorted(unknown))}")
+            inputs = dict(defaults, mask_video_path="")
+            inputs.update(item)
+            result.append(inputs)
         return result
 
+    @classmethod
+    def IS_CHANGED(cls, entries, max_workers=None, **kwargs):
+        try:
+            keys = [cls.get_cache_state(inputs) for inputs in cls.parse_entries(entries, kwargs)]
+        except (OSError, ValueError):
+            return float("nan")
+        return hashlib.sha1("|".join(keys).encode("utf-8")).hexdigest()
+
+    def batch_overlay_videos(self, big_video_path, entries,
+                             opacity, position, margin_x, margin_y, size_ratio,
+                             big_video_audio_volume, small_video_audio_volume,
+                             big_video_speed, small_video_speed, max_workers,
+                             encoding_profile="balanced", encoder_preset="auto", crf=-1,
+                             threads=0, video_codec="auto", draft_downscale=0.5, parallel_segments=1,
+                             mask_analysis=True, output_resolution="source",
+                             big_start=0.0, big_end=0.0, small_start=0.0, small_end=0.0,
+                             overlay_start=0.0, overlay_end=0.0, video_fps=0.0, background_cache=False):
+        """批量执行视频合成"""
+        defaults = dict(locals())
+        for key in ("self", "entries", "max_workers"):
+            del defaults[key]
+
+        if not os.path.exists(big_video_path):
+            raise FileNotFoundError(f"文件不存在: {big_video_path}")
+        items = self.parse_entries(entries, defaults)
+
+        # 大视频只分析一次，之后各条目都命中探测缓存
+        big_info = get_media_info(big_video_path)
+        print(f"[VideoOverlay] 批量合成: {len(items)} 个条目, 大视频 {big_info['width']}x{big_info['height']}, {big_info['duration']:.2f}秒")
+
+        # 已有渲染结果的条目不需要共享中间文件
+        pending_speeds = [
+            inputs["big_video_speed"] for inputs in items
+            if not lookup_render_cache(self.get_output_path(self.get_render_key(inputs)))
+        ]
+
+        # 每个 ffmpeg 分到的编码线程数
+        workers = max(1, min(max_workers, len(items)))
+        encoding_overrides = {}
+        if threads <= 0:
+            encoding_overrides["threads"] = max(1, (os.cpu_count() or 1) // workers)
+
+        work_dir = os.path.join(
+            folder_paths.get_temp_directory(), f"overlay_batch_{str(uuid.uuid4())[:8]}"
+        )
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            # 同一速度被多个条目使用时，先调速一次，条目按 1.0x 合成；
+            # 开启 background_cache 时使用（或生成）持久缓存的中间文件，只有一个条目使用的速度也会缓存
+            backgrounds = {}
+            for speed in sorted(set(pending_speeds)):
+                if speed == 1.0:
+                    continue
+                if background_cache:
+                    backgrounds[speed] = (self.cached_background(
+                        big_video_path, speed, keep=[path for path, _ in backgrounds.values()]
+                    ), 1.0)
+                elif pending_speeds.count(speed) > 1:
+                    try:
+                        output_path = os.path.join(work_dir, f"background_{speed:g}x.mkv")
+                        backgrounds[speed] = (self.conform_background(big_video_path, speed, output_path), 1.0)
+                    except ffmpeg.Error as e:
+                        error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
+                        print(f"[VideoOverlay] ✗ FFmpeg错误:\n{error_msg}")
+                        raise RuntimeError(f"大视频调速失败: {error_msg}")
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(
+                        self.render_overlay,
+                        inputs,
+                        backgrounds.get(inputs["big_video_speed"]),
+                        encoding_overrides,
+                        False,
+                    )
+                    for inputs in items
+                ]
+                # 进度条按完成的条目数前进
+                bar = comfy_progress_bar(len(items))
+                output_paths = []
+                for idx, future in enumerate(futures):
+                    output_paths.append(future.result()["result"][0])
+                    if bar:
+                        bar.update_absolute(idx + 1, len(items))
+                    print(f"[VideoOverlay] 批量进度: {idx + 1}/{len(items)}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        print(f"[VideoOverlay] ✓ 批量合成完成: {len(output_paths)} 个视频")
+        return {
+            "ui": {"videos": [os.path.basename(path) for path in output_paths]},
+            "result": (output_paths,),
+        }
+
+
+class VideoOverlayMultiLayerNode(VideoOverlayNode):
+    """多图层画中画合成：一个大视频 + 任意数量的小视频图层，一次解码、一次编码
+
+    - 每个图层是一个 JSON 对象，必须包含 small_video_path；mask_video_path 可省略（使用小视频自带的 alpha），
+      其余字段（opacity、position、size_ratio、small_video_speed、overlay_start ...）可选，用于覆盖节点上的默认值
+    - 图层按数组顺序从下到上叠加，全部编译进同一个滤镜图，不再串联多个节点重复解码、编码
+    - 输出时长取所有图层中最长的一个，各图层的冻结、循环和音频补齐都以此为准
+    """
+
+    # 每个图层可以单独指定的字段
+    LAYER_KEYS = ("small_video_path", "mask_video_path", "opacity", "position", "margin_x", "margin_y",
+                  "size_ratio", "small_video_audio_volume", "small_video_speed",
+                  "small_start", "small_end", "overlay_start", "overlay_end")
+    OUTPUT_PREFIX = "overlay_layers"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        base = VideoOverlayNode.INPUT_TYPES()
+        required = {"big_video_path": base["required"]["big_video_path"]}
+        required["layers"] = ("STRING", {
+            "default": '[\n  {"small_video_path": "", "mask_video_path": "", "position": "right_bottom"},\n'
+                       '  {"small_video_path": "", "mask_video_path": "", "position": "left_top"}\n]',
+            "multiline": True,
+        })
+        for key, value in base["required"].items():
+            if key not in cls.CACHE_INPUT_KEYS:
+                required[key] = value
+        return {
+            "required": required,
+            "optional": base["optional"],
+        }
+
+    RETURN_TYPES = ("STRING", "VIDEO_GRAPH")
+    RETURN_NAMES = ("video_path", "video_graph")
+    FUNCTION = "overlay_layers"
+    OUTPUT_NODE = True
+    CATEGORY = "video"
+
+    @classmethod
+    def parse_layers(cls, layers, defaults):
+        """解析图层 JSON，返回每个图层完整的参数"""
+        try:
+            items = json.loads(layers) if isinstance(layers, str) else layers
+        except json.JSONDecodeError as e:
+            raise ValueError(f"图层不是合法的JSON: {e}")
+        if not isinstance(items, list) or not items:
+            raise ValueError("图层必须是非空的JSON数组")
+
+        result = []
+        for idx, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError(f"第 {idx + 1} 个图层必须是JSON对象")
+            if not item.get("small_video_path"):
+                raise ValueError(f"第 {idx + 1} 个图层缺少 small_video_path")
+            unknown = set(item) - set(cls.LAYER_KEYS)
+            if unknown:
+                raise ValueError(f"第 {idx + 1} 个图层包含不支持的字段: {', '.join(sorted(unknown))}")
+            layer = {key: defaults[key] for key in cls.LAYER_KEYS if key in defaults}
+            layer["mask_video_path"] = ""
+            layer.update(item)
+            result.append(layer)
+        return result
+
+    @classmethod
+    def get_render_key(cls, inputs):
+        # 所有图层的文件都参与指纹计算
+        inputs, graph = pop_graph_inputs(inputs)
+        layers = cls.parse_layers(inputs["layers"], inputs)
+        paths = [inputs["big_video_path"]] if inputs["big_video_path"] else []
+        for layer in layers:
+            paths += [layer[k] for k in ("small_video_path", "mask_video_path") if layer.get(k)]
+        params = {k: v for k, v in inputs.items() if k not in ("big_video_path", "layers") + RENDER_KEY_IGNORED_INPUTS}
+        params["layers"] = layers
+        if graph is not None:
+            params["big_video_graph"] = graph.render_key
+        params["node"] = cls.__name__
+        return compute_cache_key(paths, params)
+
+    @classmethod
+    def get_video_key(cls, inputs):
+        # 各图层的音量在 layers JSON 中，不单独复用画面，总是整段渲染
+        return None
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        try:
+            return cls.get_cache_state(kwargs)
+        except (OSError, ValueError):
+            return float("nan")
+
+    def plan_layer(self, inputs, layer, encoding, total_dur=0):
+        """按节点输入和图层参数规划一个图层（大视频相关的参数所有图层共用）"""
+        return self.plan_overlay(
+            inputs["big_video_path"], layer["small_video_path"], layer["mask_video_path"],
+            layer["opacity"], layer["position"], layer["margin_x"], layer["margin_y"], layer["size_ratio"],
+            inputs["big_video_audio_volume"], layer["small_video_audio_volume"],
+            inputs["big_video_speed"], layer["small_video_speed"], encoding,
+            inputs["mask_analysis"], inputs["video_fps"],
+            {
+                "big_start": inputs["big_start"], "big_end": inputs["big_end"],
+                "small_start": layer["small_start"], "small_end": layer["small_end"],
+            },
+            (layer["overlay_start"], layer["overlay_end"]),
+            total_dur,
+        )
+
+    def overlay_layers(self, big_video_path, layers,
+                       opacity, position, margin_x, margin_y, size_ratio,
+                       big_video_audio_volume, small_video_audio_volume,
+                       big_video_speed, small_video_speed,
+                       encoding_profile="balanced", encoder_preset="auto", crf=-1,
+                       threads=0, video_codec="auto", draft_downscale=0.5, parallel_segments=1,
+                       mask_analysis=True, output_resolution="source",
+                       big_start=0.0, big_end=0.0, small_start=0.0, small_end=0.0,
+                       overlay_start=0.0, overlay_end=0.0, video_fps=0.0,
+                       big_video_graph=None, lazy_output=False, background_cache=False):
+        """执行多图层视频合成"""
+        render_inputs = dict(locals())
+        del render_inputs["self"]
+        return self.render_overlay(render_inputs)
+
+    def input_paths(self, render_inputs):
+        # 所有图层的小视频和 mask
+        paths = [render_inputs["big_video_path"]] if render_inputs.get("big_video_graph") is None else []
+        for item in self.parse_layers(render_inputs["layers"], render_inputs):
+            paths += [item[k] for k in ("small_video_path", "mask_video_path") if item[k]]
+        return paths
+
+    def plan_render(self, render_inputs, big_video, encoding):
+        """逐个规划图层，返回 (第一个图层的 plan, 所有图层的 plan)"""
+        items = self.parse_layers(render_inputs["layers"], render_inputs)
+        render_inputs = dict(render_inputs, **big_video)
+        plans = []
+        for idx, item in enumerate(items):
+            print(f"[VideoOverlay] 图层 {idx + 1}/{len(items)}: {os.path.basename(item['small_video_path'])}")
+            plans.append(self.plan_layer(render_inputs, item, encoding))
+            # 上游视频图需要循环或裁剪时已经渲染成文件，其余图层直接使用该文件
+            render_inputs["big_video_path"] = plans[-1]["big_video_path"]
+
+        # 输出时长取最长的图层，较短的图层按总时长重新规划（冻结、循环、音频补齐）
+        total_dur = max(plan["max_dur"] for plan in plans)
+        for idx, item in enumerate(items):
+            if plans[idx]["max_dur"] < total_dur:
+                print(f"[VideoOverlay] 图层 {idx + 1} 按总时长 {total_dur:.2f}秒 重新规划")
+                plans[idx] = self.plan_layer(render_inputs, item, encoding, total_dur)
+                render_inputs["big_video_path"] = plans[idx]["big_video_path"]
+
+        # 所有图层必须叠加在同一个大视频上
+        for idx, item in enumerate(items):
+            if plans[idx]["big_video_path"] != render_inputs["big_video_path"]:
+                plans[idx] = self.plan_layer(render_inputs, item, encoding, total_dur)
+
+        print(f"[VideoOverlay] 多图层合成: {len(plans)} 个图层")
+        return plans[0], plans
+
+
+# 合并字幕（merge_cues）：句末标点之后不再合并
+SENTENCE_END_CHARS = "。！？!?.…"
+
+
+def join_cue_text(left, right):
+    """拼接相邻两条字幕的文字：英文单词之间补空格，中文直接相连"""
+    if not left:
+        return right
+    if not right or left[-1].isspace() or right[0].isspace():
+        return left + right
+    if left[-1].isascii() and right[0].isascii():
+        return f"{left} {right}"
+    return left + right
+
+
+def cue_merge_input_types():
+    """合并字幕的可选输入（字幕节点和 String2AlignmentNode 共用）"""
+    return {
+        "merge_cues": ("BOOLEAN", {
+            "default": False,  # 把逐词的字幕合并成整行
+        }),
+        "cue_max_gap": ("FLOAT", {
+            "default": 0.3,  # 与上一行间隔不超过该秒数时合并
+            "min": 0.0,
+            "max": 5.0,
+            "step": 0.05,
+        }),
+        "cue_max_chars": ("INT", {
+            "default": 42,  # 每行最多字符数，0 表示不限制
+            "min": 0,
+            "max": 500,
+            "step": 1,
+        }),
+        "cue_max_duration": ("FLOAT", {
+            "default": 6.0,  # 每行最长秒数，0 表示不限制
+            "min": 0.0,
+            "max": 60.0,
+            "step": 0.5,
+        }),
+    }
+
+
+class AlignmentTrack:
+    """紧凑的字幕时间轴：按开始时间排序的 start/end 数组 + 去重的文字表
+
+    - 可以像 whisper_alignment 列表一样遍历、取下标，元素为 {"value", "start", "end"} 字典
+    - end 的前缀最大值作为区间索引，query/slice 只需二分查找，不再线性扫描所有字幕
+    - coalesce 把逐词的字幕合并成整行
+    """
+
+    def __init__(self, starts=(), ends=(), texts=()):
+        order = sorted(range(len(starts)), key=lambda i: (starts[i], ends[i]))
+        self.starts = array('d', (starts[i] for i in order))
+        self.ends = array('d', (ends[i] for i in order))
+        # 相同的文字只保存一份
+        self.strings = []
+        string_ids = {}
+        self.text_ids = array('I')
+        for i in order:
+            text = texts[i]
+            if text not in string_ids:
+                string_ids[text] = len(self.strings)
+                self.strings.append(text)
+            self.text_ids.append(string_ids[text])
+        # max_ends[i] = max(ends[:i+1])，单调不减，用于查找第一个可能与区间重叠的字幕
+        self.max_ends = array('d', accumulate(self.ends, max))
+
+    @classmethod
+    def from_segments(cls, segments):
+        """由 [{"value", "start", "end"}, ...] 构建；缺少字段或时长不为正的条目被忽略"""
+        if isinstance(segments, cls):
+            return segments
+        starts, ends, texts = [], [], []
+        skipped = 0
+        for segment in segments or []:
+            try:
+                start, end = float(segment["start"]), float(segment["end"])
+                text = str(segment["value"])
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+                continue
+            if end <= start:
+                skipped += 1
+                continue
+            starts.append(start)
+            ends.append(end)
+            texts.append(text)
+        if skipped:
+            print(f"[VideoOverlay] 警告: 忽略了 {skipped} 条无效字幕")
+        return cls(starts, ends, texts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        return {"value": self.strings[self.text_ids[idx]], "start": self.starts[idx], "end": self.ends[idx]}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def to_list(self):
+        """转换为 whisper_alignment 列表"""
+        return list(self)
+
+    def query(self, start, end):
+        """与 [start, end) 重叠的字幕下标（按开始时间排序）"""
+        lo = bisect_right(self.max_ends, start)
+        hi = bisect_left(self.starts, end)
+        return [idx for idx in range(lo, hi) if self.ends[idx] > start]
+
+    def slice(self, start, duration):
+        """取出与 [start, start+duration) 重叠的字幕，时间平移为段内时间并裁剪到段边界"""
+        indices = self.query(start, start + duration)
+        return AlignmentTrack(
+            [max(0.0, self.starts[idx] - start) for idx in indices],
+            [min(duration, self.ends[idx] - start) for idx in indices],
+            [self.strings[self.text_ids[idx]] for idx in indices],
+        )
+
+    def coalesce(self, max_gap=0.3, max_chars=42, max_duration=6.0):
+        """把相邻或重叠的字幕合并成整行
+
+        与上一行的间隔不超过 max_gap 秒、合并后不超过 max_chars 个字符且不超过 max_duration 秒时合并，
+        上一行以句末标点结束时另起一行；max_chars、max_duration 为 0 表示不限制。
+        """
+        starts, ends, texts = [], [], []
+        for idx in range(len(self)):
+            start, end = self.starts[idx], self.ends[idx]
+            text = self.strings[self.text_ids[idx]]
+            if texts:
+                joined = join_cue_text(texts[-1], text)
+                if (start - ends[-1] <= max_gap
+                        and not texts[-1].rstrip().endswith(tuple(SENTENCE_END_CHARS))
+                        and (max_chars <= 0 or len(joined.strip()) <= max_chars)
+                        and (max_duration <= 0 or max(end, ends[-1]) - starts[-1] <= max_duration)):
+                    ends[-1] = max(end, ends[-1])
+                    texts[-1] = joined
+                    continue
+            starts.append(start)
+            ends.append(end)
+            texts.append(text)
+        return AlignmentTrack(starts, ends, [text.strip() for text in texts])
+
+
+class VideoOverlayWithSubtitlesNode(VideoOverlayNode):
+    """视频画中画合成节点（带字幕）"""
+
     @classmethod
     def INPUT_TYPES(cls):
         # 获取可用字体列表
@@ -640,86 +3015,73 @@ class VideoOverlayWithSubtitlesNode:
                 "subtitle_bg_color": ("STRING", {
                     "default": "black",
                 }),
+                # ass: 所有字幕写入一个 ASS 文件，由单个 libass 滤镜渲染
+                # drawtext: 每条字幕一个 drawtext 滤镜（字幕很多时非常慢）
+                "subtitle_renderer": (["ass", "drawtext"], {
+                    "default": "ass"
+                }),
+                **render_input_types(),
+                **graph_input_types(),
+                "background_cache": ("BOOLEAN", {
+                    "default": False,  # 把调速后的大视频缓存为中间文件，之后相同大视频和速度直接读取
+                }),
+                "composite_cache": ("BOOLEAN", {
+                    "default": False,  # 缓存不带字幕的合成结果，只改字幕时只重新烧录字幕（首次渲染多编码一次）
+                }),
+                **cue_merge_input_types(),
             }
         }
 
-    RETURN_TYPES = ("STRING",)
-    RETURN_NAMES = ("video_path",)
+    RETURN_TYPES = ("STRING", "VIDEO_GRAPH")
+    RETURN_NAMES = ("video_path", "video_graph")
     FUNCTION = "overlay_videos_with_subtitles"
     OUTPUT_NODE = True
     CATEGORY = "video"
 
-    def get_video_info(self, video_path):
-        """获取视频的时长和分辨率"""
-        try:
-            probe = ffmpeg.probe(video_path)
-            video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-
-            width = int(video_info['width'])
-            height = int(video_info['height'])
-            duration = float(probe['format']['duration'])
-
-            # 尝试获取帧率
-            fps_str = video_info.get('r_frame_rate', '24/1')
-            num, denom = map(int, fps_str.split('/'))
-            fps = num / denom if denom != 0 else 24.0
-
-            return width, height, duration, fps
-        except Exception as e:
-            raise ValueError(f"无法读取视频信息: {video_path}\n错误: {e}")
-
-    def get_overlay_position(self, position, big_w, big_h, overlay_w, overlay_h, margin_x, margin_y):
-        """根据位置参数计算overlay的x, y坐标"""
-        positions = {
-            "right_bottom": (f"main_w-overlay_w-{margin_x}", f"main_h-overlay_h-{margin_y}"),
-            "right_top": (f"main_w-overlay_w-{margin_x}", str(margin_y)),
-            "left_bottom": (str(margin_x), f"main_h-overlay_h-{margin_y}"),
-            "left_top": (str(margin_x), str(margin_y)),
-            "center": ("(main_w-overlay_w)/2", "(main_h-overlay_h)/2"),
-        }
-        return positions.get(position, positions["right_bottom"])
+    OUTPUT_PREFIX = "overlay_subtitle"
 
-    def get_subtitle_position(self, position, x_custom, y_custom):
+    def get_subtitle_position(self, position, x_custom, y_custom, margin=50):
         """根据字幕位置参数计算x, y表达式"""
         positions = {
-            "bottom_center": ("(w-text_w)/2", "h-th-50"),
-            "top_center": ("(w-text_w)/2", "50"),
-            "bottom_left": ("50", "h-th-50"),
-            "bottom_right": ("w-text_w-50", "h-th-50"),
+            "bottom_center": ("(w-text_w)/2", f"h-th-{margin}"),
+            "top_center": ("(w-text_w)/2", str(margin)),
+            "bottom_left": (str(margin), f"h-th-{margin}"),
+            "bottom_right": (f"w-text_w-{margin}", f"h-th-{margin}"),
             "center": ("(w-text_w)/2", "(h-th)/2"),
             "custom": (str(x_custom), str(y_custom)),
         }
         return positions.get(position, positions["bottom_center"])
 
     def parse_alignment(self, alignment_input):
-        """解析alignment为列表
+        """解析alignment为 AlignmentTrack
 
-        支持两种输入：
+        支持三种输入：
         1. whisper_alignment 类型（列表）
         2. JSON 字符串
+        3. AlignmentTrack
         """
-        # 如果是None或空，返回空列表
+        # 如果是None或空，返回空时间轴
         if alignment_input is None:
-            return []
+            return AlignmentTrack()
 
-        # 如果已经是列表，直接返回
-        if isinstance(alignment_input, list):
-            return alignment_input
+        # 如果已经是列表或时间轴，直接转换
+        if isinstance(alignment_input, (list, AlignmentTrack)):
+            return AlignmentTrack.from_segments(alignment_input)
 
         # 如果是字符串，尝试解析JSON
         if isinstance(alignment_input, str):
             if not alignment_input or alignment_input.strip() == "[]":
-                return []
+                return AlignmentTrack()
             try:
                 import json
                 alignment = json.loads(alignment_input)
-                return alignment if isinstance(alignment, list) else []
+                return AlignmentTrack.from_segments(alignment if isinstance(alignment, list) else [])
             except:
                 print("[VideoOverlay] 警告: 无法解析alignment，将不添加字幕")
-                return []
+                return AlignmentTrack()
 
-        # 其他情况返回空列表
-        return []
+        # 其他情况返回空时间轴
+        return AlignmentTrack()
 
     def escape_ffmpeg_text(self, text):
         """转义FFmpeg drawtext滤镜中的特殊字符
@@ -794,6 +3156,263 @@ class VideoOverlayWithSubtitlesNode:
         # 用换行符连接
         return '\n'.join(lines)
 
+    def get_ass_layout(self, position, margin=50):
+        """字幕位置 → (ASS 对齐方式, MarginL, MarginR, MarginV)，与 drawtext 预设位置保持一致"""
+        layouts = {
+            "bottom_center": (2, 0, 0, margin),
+            "top_center": (8, 0, 0, margin),
+            "bottom_left": (1, margin, 0, margin),
+            "bottom_right": (3, 0, margin, margin),
+            "center": (5, 0, 0, 0),
+            "custom": (7, 0, 0, 0),
+        }
+        return layouts.get(position, layouts["bottom_center"])
+
+    def escape_ass_text(self, text):
+        """转义 ASS 对话文本
+
+        - 反斜杠后插入零宽空格，避免被解释为 \\N 等控制序列
+        - 花括号会开启样式覆盖块，需要转义
+        - 换行符转换为 ASS 的 \\N
+        """
+        text = text.replace('\\', '\\\u200b')
+        text = text.replace('{', '\\{').replace('}', '\\}')
+        return text.replace('\n', '\\N')
+
+    def format_ass_time(self, seconds):
+        """秒 → ASS 时间格式 H:MM:SS.cc"""
+        centiseconds = int(round(max(0.0, float(seconds)) * 100))
+        hours, centiseconds = divmod(centiseconds, 360000)
+        minutes, centiseconds = divmod(centiseconds, 6000)
+        secs, centiseconds = divmod(centiseconds, 100)
+        return f"{hours}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
+
+    def prepare_font_dir(self, font_path):
+        """为 libass 准备只包含所选字体的目录，避免同名字族的其他字重被优先匹配"""
+        digest = hashlib.sha1(os.path.abspath(font_path).encode("utf-8")).hexdigest()[:12]
+        fonts_dir = os.path.join(folder_paths.get_temp_directory(), "video_overlay_fonts", digest)
+        target = os.path.join(fonts_dir, os.path.basename(font_path))
+        if not os.path.exists(target):
+            os.makedirs(fonts_dir, exist_ok=True)
+            shutil.copyfile(font_path, target)
+        return fonts_dir
+
+    def write_ass_subtitles(self, alignment_list, video_w, video_h, font_path, font_size, font_color,
+                            subtitle_position, x_position, y_position, text_width,
+                            subtitle_bg_color, subtitle_bg_opacity, margin=50):
+        """把 alignment 写成一个 ASS 字幕文件，返回 (ass文件路径, 字体目录)
+
+        样式与 drawtext 版本对应：字体/字号/颜色、半透明背景框（BorderStyle=3）、预设位置或自定义坐标。
+        """
+        alignment_code, margin_l, margin_r, margin_v = self.get_ass_layout(subtitle_position, margin)
+        primary = to_ass_color(font_color)
+        box = to_ass_color(subtitle_bg_color, subtitle_bg_opacity)
+
+        lines = [
+            "[Script Info]",
+            "ScriptType: v4.00+",
+            f"PlayResX: {video_w}",
+            f"PlayResY: {video_h}",
+            # 已经按 wrap_text 手动换行，禁止 libass 再自动换行
+            "WrapStyle: 2",
+            "ScaledBorderAndShadow: yes",
+            "",
+            "[V4+ Styles]",
+            "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+            "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+            "Alignment, MarginL, MarginR, MarginV, Encoding",
+            f"Style: Default,{get_font_name(font_path)},{font_size},{primary},{primary},{box},{box},"
+            f"0,0,0,0,100,100,0,0,3,10,0,{alignment_code},{margin_l},{margin_r},{margin_v},1",
+            "",
+            "[Events]",
+            "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+        ]
+
+        position_tag = ""
+        if subtitle_position == "custom":
+            position_tag = f"{{\\an7\\pos({x_position},{y_position})}}"
+
+        for segment in alignment_list:
+            wrapped_text = self.wrap_text(segment["value"], text_width, font_size)
+            text = self.escape_ass_text(wrapped_text)
+            start = self.format_ass_time(segment["start"])
+            end = self.format_ass_time(segment["end"])
+            lines.append(f"Dialogue: 0,{start},{end},Default,,0,0,0,,{position_tag}{text}")
+
+        # 由使用它的 ffmpeg 进程结束后删除（见 register_graph_temp_file）
+        ass_path = register_graph_temp_file(
+            os.path.join(folder_paths.get_temp_directory(), f"subtitles_{uuid.uuid4().hex}.ass")
+        )
+        with open(ass_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+        return ass_path, self.prepare_font_dir(font_path)
+
+    def apply_drawtext_subtitles(self, video_out, alignment_list, font_path, font_size, font_color,
+                                 subtitle_position, x_position, y_position, text_width,
+                                 subtitle_bg_color, subtitle_bg_opacity, margin=50):
+        """为每条字幕串联一个 drawtext 滤镜（旧的渲染方式）
+
+        滤镜链文本按字幕和样式缓存，相同参数再次渲染时直接复用（见 apply_filter_chain）
+        """
+        params = {
+            "alignment": AlignmentTrack.from_segments(alignment_list), "font_path": font_path,
+            "font_size": font_size, "font_color": font_color, "position": subtitle_position,
+            "x": x_position, "y": y_position, "text_width": text_width, "bg_color": subtitle_bg_color,
+            "bg_opacity": subtitle_bg_opacity, "margin": margin,
+        }
+        return apply_filter_chain(
+            video_out, params,
+            lambda: self.build_drawtext_filters(
+                alignment_list, font_path, font_size, font_color, subtitle_position, x_position, y_position,
+                text_width, subtitle_bg_color, subtitle_bg_opacity, margin
+            )
+        )
+
+    def build_drawtext_filters(self, alignment_list, font_path, font_size, font_color,
+                               subtitle_position, x_position, y_position, text_width,
+                               subtitle_bg_color, subtitle_bg_opacity, margin=50):
+        """每条字幕一个 drawtext 滤镜的文本列表"""
+        # 获取字幕位置
+        sub_x, sub_y = self.get_subtitle_position(subtitle_position, x_position, y_position, margin)
+
+        # 为每个字幕段创建drawtext滤镜
+        filters = []
+        for idx, segment in enumerate(alignment_list):
+            # 先进行文本换行处理
+            wrapped_text = self.wrap_text(segment["value"], text_width, font_size)
+            # 再进行转义
+            text = self.escape_ffmpeg_text(wrapped_text)
+            start_time = segment["start"]
+            end_time = segment["end"]
+
+            # 构建drawtext参数
+            drawtext_params = {
+                'fontfile': font_path,
+                'text': text,
+                'fontsize': font_size,
+                'fontcolor': font_color,
+                'x': sub_x,
+                'y': sub_y,
+                'box': 1,
+                'boxcolor': f"{subtitle_bg_color}@{subtitle_bg_opacity}",
+                'boxborderw': 10,
+                'line_spacing': 5,
+                'enable': f"between(t,{start_time},{end_time})"
+            }
+
+            filters.append(format_filter('drawtext', **drawtext_params))
+
+            if (idx + 1) % 10 == 0:
+                print(f"[VideoOverlay] 已处理 {idx + 1}/{len(alignment_list)} 条字幕")
+
+        return filters
+
+    def slice_alignment(self, alignment_list, start, duration):
+        """取出与 [start, start+duration) 重叠的字幕，时间平移为段内时间并裁剪到段边界"""
+        return AlignmentTrack.from_segments(alignment_list).slice(start, duration)
+
+    def apply_subtitles(self, video_out, alignment_list, style, plan):
+        """按 subtitle_style 把字幕烧录到视频流上"""
+        if style["renderer"] == "ass":
+            # 所有字幕合并为一个 ASS 文件，只用一个滤镜渲染，开销只与可见文字有关
+            ass_path, fonts_dir = self.write_ass_subtitles(
+                alignment_list, plan["canvas_w"], plan["canvas_h"], style["font_path"], style["font_size"],
+                style["font_color"], style["position"], style["x"], style["y"], style["text_width"],
+                style["bg_color"], style["bg_opacity"], style["margin"]
+            )
+            print(f"[VideoOverlay] 已生成ASS字幕: {os.path.basename(ass_path)}")
+            return ffmpeg.filter(video_out, 'ass', ass_path, fontsdir=fonts_dir)
+
+        return self.apply_drawtext_subtitles(
+            video_out, alignment_list, style["font_path"], style["font_size"], style["font_color"],
+            style["position"], style["x"], style["y"], style["text_width"],
+            style["bg_color"], style["bg_opacity"], style["margin"]
+        )
+
+    @classmethod
+    def get_composite_key(cls, inputs):
+        """不带字幕的合成结果的缓存键：去掉字幕参数和只影响最终编码的参数"""
+        ignored = SUBTITLE_INPUT_KEYS + COMPOSITE_IGNORED_INPUTS
+        return cls.get_render_key({k: v for k, v in inputs.items() if k not in ignored})
+
+    def render_plan(self, plan, output_path, encoding, parallel_segments=1, layer_plans=None,
+                    allow_passthrough=True, show_progress=True):
+        """plan 带有 composite_path 时分两步渲染：不带字幕的合成结果（命中缓存时跳过）→ 烧录字幕，音频直接复制"""
+        composite_path = plan.get("composite_path")
+        if not composite_path:
+            return super().render_plan(
+                plan, output_path, encoding, parallel_segments, layer_plans, allow_passthrough, show_progress
+            )
+
+        alignment_list, subtitle_style = plan["subtitles"]
+        composite_name = os.path.basename(composite_path)
+        if lookup_render_cache(composite_path):
+            print(f"[VideoOverlay] ✓ 命中合成缓存: {composite_name}，只重新烧录字幕")
+        else:
+            # 中间文件用高质量的快速编码，第二次编码的损失可以忽略
+            print(f"[VideoOverlay] 生成不带字幕的合成结果: {composite_name}")
+            os.makedirs(COMPOSITE_CACHE_DIR, exist_ok=True)
+            partial_path = f"{composite_path}.{str(uuid.uuid4())[:8]}.partial.mp4"
+            composite_encoding = dict(encoding, vcodec="libx264", preset="ultrafast", crf=COMPOSITE_CRF)
+            try:
+                super().render_plan(
+                    dict(plan, subtitles=([], subtitle_style)), partial_path, composite_encoding,
+                    parallel_segments, layer_plans, False, show_progress
+                )
+                os.replace(partial_path, composite_path)
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+            # 接下来的烧录还要读取刚生成的合成结果
+            evict_render_cache(
+                COMPOSITE_CACHE_DIR, COMPOSITE_CACHE_MAX_BYTES, COMPOSITE_CACHE_PATTERN, keep=[composite_path]
+            )
+
+        # 烧录字幕：只解码合成结果、渲染字幕和编码视频
+        max_dur = plan["max_dur"]
+        segments = self.plan_segments(plan, parallel_segments)
+        print(f"[VideoOverlay] 烧录字幕...")
+        progress = RenderProgress(max_dur) if show_progress else None
+        composite = ffmpeg.input(composite_path)
+        # 合成结果没有音频（全部静音）时输出也不带音频
+        composite_audio = composite.audio if self.plan_audio(plan, layer_plans)["audible"] else None
+        if len(segments) > 1:
+            def build_segment(start, duration):
+                segment_video = ffmpeg.input(composite_path, ss=start, t=duration).video
+                segment_alignment = self.slice_alignment(alignment_list, start, duration)
+                if segment_alignment:
+                    segment_video = self.apply_subtitles(segment_video, segment_alignment, subtitle_style, plan)
+                return segment_video
+
+            self.render_segments(
+                build_segment, composite_audio, max_dur, output_path, encoding, segments, progress,
+                audio_codec='copy'
+            )
+            return
+
+        video_out = self.apply_subtitles(composite.video, alignment_list, subtitle_style, plan)
+        output_stream = ffmpeg.output(
+            *[stream for stream in (video_out, composite_audio) if stream is not None],
+            output_path,
+            t=max_dur,
+            acodec='copy',
+            **get_output_kwargs(encoding)
+        )
+        run_ffmpeg(output_stream, progress.callback() if progress else None)
+
+    def build_output(self, plan, segment=None, layer_plans=None):
+        """合成后烧录字幕；分段时只保留与该段重叠的字幕，时间平移到段内，跨越切点的字幕在两段中各显示一部分"""
+        video_out, audio_out = super().build_output(plan, segment, layer_plans)
+        alignment_list, subtitle_style = plan["subtitles"]
+        if segment:
+            alignment_list = self.slice_alignment(alignment_list, *segment)
+        elif alignment_list:
+            print(f"[VideoOverlay] 添加字幕到视频...")
+        if alignment_list:
+            video_out = self.apply_subtitles(video_out, alignment_list, subtitle_style, plan)
+        return video_out, audio_out
+
     def overlay_videos_with_subtitles(self, big_video_path, small_video_path, mask_video_path,
                                      opacity, position, margin_x, margin_y, size_ratio,
                                      big_video_audio_volume, small_video_audio_volume,
@@ -808,332 +3427,110 @@ class VideoOverlayWithSubtitlesNode:
                                      subtitle_position="bottom_center",
                                      max_subtitle_width=0,
                                      subtitle_bg_opacity=0.7,
-                                     subtitle_bg_color="black"):
+                                     subtitle_bg_color="black",
+                                     subtitle_renderer="ass",
+                                     encoding_profile="balanced",
+                                     encoder_preset="auto",
+                                     crf=-1,
+                                     threads=0,
+                                     video_codec="auto",
+                                     draft_downscale=0.5,
+                                     parallel_segments=1,
+                                     mask_analysis=True,
+                                     output_resolution="source",
+                                     big_start=0.0,
+                                     big_end=0.0,
+                                     small_start=0.0,
+                                     small_end=0.0,
+                                     overlay_start=0.0,
+                                     overlay_end=0.0,
+                                     big_video_graph=None,
+                                     lazy_output=False,
+                                     background_cache=False,
+                                     composite_cache=False,
+                                     merge_cues=False,
+                                     cue_max_gap=0.3,
+                                     cue_max_chars=42,
+                                     cue_max_duration=6.0):
         """执行视频合成和字幕添加"""
+        render_inputs = dict(locals())
+        del render_inputs["self"]
 
-        # 检查文件是否存在
-        for path in [big_video_path, small_video_path, mask_video_path]:
-            if not os.path.exists(path):
-                raise FileNotFoundError(f"文件不存在: {path}")
         # 如果font是相对路径
-        if not os.path.isabs(font_path):
-            font_path=os.path.join(FONT_DIR, font_path)
-            if not os.path.exists(font_path):
-                raise FileNotFoundError(f"字体文件不存在: {font_path}")
-
-        # 获取视频信息
-        print(f"[VideoOverlay] 正在分析视频信息...")
-        big_w, big_h, big_dur, big_fps = self.get_video_info(big_video_path)
-        small_w, small_h, small_dur, small_fps = self.get_video_info(small_video_path)
-
-        print(f"[VideoOverlay] 大视频: {big_w}x{big_h}, {big_dur:.2f}秒, {big_fps:.2f}fps")
-        print(f"[VideoOverlay] 小视频: {small_w}x{small_h}, {small_dur:.2f}秒, {small_fps:.2f}fps")
-
-        # 计算小视频目标尺寸
-        target_height = int(big_h * size_ratio)
-        target_width = int(target_height * small_w / small_h)
-
-        print(f"[VideoOverlay] 小视频目标尺寸: {target_width}x{target_height}")
-        print(f"[VideoOverlay] 透明度: {opacity}, 位置: {position}")
-        print(f"[VideoOverlay] 音频混合 - 大视频: {big_video_audio_volume}, 小视频: {small_video_audio_volume}")
-        print(f"[VideoOverlay] 视频速度 - 大视频: {big_video_speed}x, 小视频: {small_video_speed}x")
+        if not os.path.isabs(font_path) and not os.path.exists(self.resolve_font_path(font_path)):
+            raise FileNotFoundError(f"字体文件不存在: {self.resolve_font_path(font_path)}")
+        return self.render_overlay(render_inputs)
 
-        # 计算调速后的实际时长
-        big_dur_adjusted = big_dur / big_video_speed
-        small_dur_adjusted = small_dur / small_video_speed
+    @staticmethod
+    def resolve_font_path(font_path):
+        """相对路径的字体在插件的 fonts 目录中查找"""
+        return font_path if os.path.isabs(font_path) else os.path.join(FONT_DIR, font_path)
 
-        print(f"[VideoOverlay] 调速后时长 - 大视频: {big_dur_adjusted:.2f}秒, 小视频: {small_dur_adjusted:.2f}秒")
+    def plan_render(self, render_inputs, big_video, encoding):
+        """画中画规划之外加上字幕（plan["subtitles"]）和分层缓存的合成结果路径（plan["composite_path"]）"""
+        plan, layer_plans = super().plan_render(render_inputs, big_video, encoding)
+        canvas_scale = plan["canvas_scale"]
 
         # 解析字幕
-        alignment_list = self.parse_alignment(alignment)
+        alignment_list = self.parse_alignment(render_inputs["alignment"])
         if alignment_list:
             print(f"[VideoOverlay] 找到 {len(alignment_list)} 条字幕")
+        if render_inputs["merge_cues"] and alignment_list:
+            alignment_list = alignment_list.coalesce(
+                render_inputs["cue_max_gap"], render_inputs["cue_max_chars"], render_inputs["cue_max_duration"]
+            )
+            print(f"[VideoOverlay] 合并为 {len(alignment_list)} 行字幕")
+
+        # 字幕样式；画布缩小时（draft 档位）字号、坐标和边距同比缩放
+        max_subtitle_width = render_inputs["max_subtitle_width"]
+        subtitle_style = {
+            "renderer": render_inputs["subtitle_renderer"],
+            "font_path": self.resolve_font_path(render_inputs["font_path"]),
+            "font_size": max(1, int(round(render_inputs["font_size"] * canvas_scale))),
+            "font_color": render_inputs["font_color"],
+            "position": render_inputs["subtitle_position"],
+            "x": int(render_inputs["x_position"] * canvas_scale),
+            "y": int(render_inputs["y_position"] * canvas_scale),
+            # 计算文本最大宽度
+            "text_width": int(max_subtitle_width * canvas_scale) if max_subtitle_width > 0 else int(plan["canvas_w"] * 0.8),
+            "bg_color": render_inputs["subtitle_bg_color"],
+            "bg_opacity": render_inputs["subtitle_bg_opacity"],
+            "margin": int(50 * canvas_scale),
+        }
 
-        # 计算overlay位置
-        overlay_x, overlay_y = self.get_overlay_position(
-            position, big_w, big_h, target_width, target_height, margin_x, margin_y
-        )
-
-        # 生成输出文件路径
-        output_dir = folder_paths.get_output_directory()
-        unique_id = str(uuid.uuid4())[:8]
-        output_filename = f"overlay_subtitle_{unique_id}.mp4"
-        output_path = os.path.join(output_dir, output_filename)
-
-        # 加载输入视频
-        big_input = ffmpeg.input(big_video_path)
-        small_input = ffmpeg.input(small_video_path)
-        mask_input = ffmpeg.input(mask_video_path)
-
-        max_dur = max(big_dur_adjusted, small_dur_adjusted)
-
-        try:
-            if big_dur_adjusted > small_dur_adjusted:
-                print(f"[VideoOverlay] 大视频更长，冻结小视频最后一帧")
-                pad_dur = big_dur_adjusted - small_dur_adjusted
-
-                # 应用调速到大视频
-                big_video = big_input.video
-                if big_video_speed != 1.0:
-                    big_video = ffmpeg.filter(big_video, 'setpts', f'{1.0/big_video_speed}*PTS')
-
-                # 应用调速到小视频
-                small_video = small_input.video
-                if small_video_speed != 1.0:
-                    small_video = ffmpeg.filter(small_video, 'setpts', f'{1.0/small_video_speed}*PTS')
-
-                # 应用调速到mask（与小视频同步）
-                mask_video = mask_input.video
-                if small_video_speed != 1.0:
-                    mask_video = ffmpeg.filter(mask_video, 'setpts', f'{1.0/small_video_speed}*PTS')
-
-                # 延长小视频
-                small_padded = ffmpeg.filter(
-                    small_video,
-                    'tpad',
-                    stop_mode='clone',
-                    stop_duration=pad_dur
-                )
-
-                # 延长mask
-                mask_padded = ffmpeg.filter(
-                    mask_video,
-                    'tpad',
-                    stop_mode='clone',
-                    stop_duration=pad_dur
-                )
-                mask_gray = ffmpeg.filter(mask_padded, 'format', 'gray')
-
-                # 缩放
-                small_scaled = ffmpeg.filter(
-                    small_padded,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                mask_scaled = ffmpeg.filter(
-                    mask_gray,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-
-                # 应用透明度到mask
-                if opacity < 1.0:
-                    mask_scaled = ffmpeg.filter(
-                        mask_scaled,
-                        'colorlevels',
-                        romax=opacity
-                    )
-
-                # 合并alpha通道
-                small_masked = ffmpeg.filter(
-                    [small_scaled, mask_scaled],
-                    'alphamerge'
-                )
-
-                # overlay
-                video_out = ffmpeg.overlay(
-                    big_video,
-                    small_masked,
-                    x=overlay_x,
-                    y=overlay_y,
-                    format='auto'
-                )
-
-                # 音频处理：混合两个音频
-                # 大视频音频调速
-                big_audio = big_input.audio
-                if big_video_speed != 1.0:
-                    big_audio = self.apply_audio_speed(big_audio, big_video_speed)
-                big_audio = ffmpeg.filter(big_audio, 'volume', big_video_audio_volume)
-
-                # 小视频音频调速后需要延长（冻结静音）
-                small_audio = small_input.audio
-                if small_video_speed != 1.0:
-                    small_audio = self.apply_audio_speed(small_audio, small_video_speed)
-                small_audio = ffmpeg.filter(small_audio, 'volume', small_video_audio_volume)
-                small_audio_padded = ffmpeg.filter(
-                    small_audio,
-                    'apad',
-                    pad_dur=pad_dur
-                )
-
-                if big_video_audio_volume > 0 and small_video_audio_volume > 0:
-                    audio_out = ffmpeg.filter([big_audio, small_audio_padded], 'amix', inputs=2, duration='longest')
-                elif big_video_audio_volume > 0:
-                    audio_out = big_audio
-                elif small_video_audio_volume > 0:
-                    audio_out = small_audio_padded
-                else:
-                    audio_out = ffmpeg.filter(big_audio, 'volume', 0)
-
-            else:
-                print(f"[VideoOverlay] 小视频更长，循环大视频")
-
-                # 应用调速到大视频
-                big_video = big_input.video
-                if big_video_speed != 1.0:
-                    big_video = ffmpeg.filter(big_video, 'setpts', f'{1.0/big_video_speed}*PTS')
-
-                # 循环大视频
-                big_loop = ffmpeg.filter(
-                    big_video,
-                    'loop',
-                    loop=-1,
-                    size=32767,
-                    start=0
-                )
-
-                # 应用调速到小视频
-                small_video = small_input.video
-                if small_video_speed != 1.0:
-                    small_video = ffmpeg.filter(small_video, 'setpts', f'{1.0/small_video_speed}*PTS')
-
-                # 应用调速到mask（与小视频同步）
-                mask_video = mask_input.video
-                if small_video_speed != 1.0:
-                    mask_video = ffmpeg.filter(mask_video, 'setpts', f'{1.0/small_video_speed}*PTS')
-
-                # 处理mask
-                mask_gray = ffmpeg.filter(mask_video, 'format', 'gray')
-
-                # 缩放
-                small_scaled = ffmpeg.filter(
-                    small_video,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-                mask_scaled = ffmpeg.filter(
-                    mask_gray,
-                    'scale',
-                    target_width,
-                    target_height,
-                    force_original_aspect_ratio='decrease'
-                )
-
-                # 应用透明度到mask
-                if opacity < 1.0:
-                    mask_scaled = ffmpeg.filter(
-                        mask_scaled,
-                        'colorlevels',
-                        romax=opacity
-                    )
-
-                # 合并alpha通道
-                small_masked = ffmpeg.filter(
-                    [small_scaled, mask_scaled],
-                    'alphamerge'
-                )
-
-                # overlay
-                video_out = ffmpeg.overlay(
-                    big_loop,
-                    small_masked,
-                    x=overlay_x,
-                    y=overlay_y,
-                    format='auto'
-                )
+        # 设置了画中画窗口时，字幕时间相对于窗口开始，只在窗口内显示
+        if plan["windowed"] and alignment_list:
+            layer_start, layer_end = plan["layer_window"]
+            alignment_list = self.slice_alignment(alignment_list, -layer_start, layer_end)
+        plan["subtitles"] = (alignment_list, subtitle_style)
+        # 分层缓存：只改字幕时复用不带字幕的合成结果；设置了画中画窗口时仍整段一次渲染，以便使用智能渲染
+        if render_inputs["composite_cache"] and alignment_list and not plan["windowed"]:
+            composite_key = self.get_composite_key(render_inputs)
+            plan["composite_path"] = os.path.join(COMPOSITE_CACHE_DIR, f"composite_{composite_key[:16]}.mp4")
+        return plan, layer_plans
 
-                # 音频处理：混合两个音频
-                # 大视频音频调速后需要循环
-                big_audio = big_input.audio
-                if big_video_speed != 1.0:
-                    big_audio = self.apply_audio_speed(big_audio, big_video_speed)
-                big_audio_loop = ffmpeg.filter(
-                    big_audio,
-                    'aloop',
-                    loop=-1,
-                    size=2e9  # 足够大的采样数
-                )
-                big_audio = ffmpeg.filter(big_audio_loop, 'volume', big_video_audio_volume)
-
-                # 小视频音频调速
-                small_audio = small_input.audio
-                if small_video_speed != 1.0:
-                    small_audio = self.apply_audio_speed(small_audio, small_video_speed)
-                small_audio = ffmpeg.filter(small_audio, 'volume', small_video_audio_volume)
-
-                if big_video_audio_volume > 0 and small_video_audio_volume > 0:
-                    audio_out = ffmpeg.filter([big_audio, small_audio], 'amix', inputs=2, duration='longest')
-                elif big_video_audio_volume > 0:
-                    audio_out = big_audio
-                elif small_video_audio_volume > 0:
-                    audio_out = small_audio
-                else:
-                    audio_out = ffmpeg.filter(small_audio, 'volume', 0)
-
-            # 添加字幕
-            if alignment_list:
-                print(f"[VideoOverlay] 添加字幕到视频...")
-
-                # 计算文本最大宽度
-                text_width = max_subtitle_width if max_subtitle_width > 0 else int(big_w * 0.8)
-
-                # 获取字幕位置
-                sub_x, sub_y = self.get_subtitle_position(subtitle_position, x_position, y_position)
-
-                # 为每个字幕段创建drawtext滤镜
-                for idx, segment in enumerate(alignment_list):
-                    # 先进行文本换行处理
-                    wrapped_text = self.wrap_text(segment["value"], text_width, font_size)
-                    # 再进行转义
-                    text = self.escape_ffmpeg_text(wrapped_text)
-                    start_time = segment["start"]
-                    end_time = segment["end"]
-
-                    # 构建drawtext参数
-                    drawtext_params = {
-                        'fontfile': font_path,
-                        'text': text,
-                        'fontsize': font_size,
-                        'fontcolor': font_color,
-                        'x': sub_x,
-                        'y': sub_y,
-                        'box': 1,
-                        'boxcolor': f"{subtitle_bg_color}@{subtitle_bg_opacity}",
-                        'boxborderw': 10,
-                        'line_spacing': 5,
-                        'enable': f"between(t,{start_time},{end_time})"
-                    }
-
-                    video_out = ffmpeg.filter(video_out, 'drawtext', **drawtext_params)
-
-                    if (idx + 1) % 10 == 0:
-                        print(f"[VideoOverlay] 已处理 {idx + 1}/{len(alignment_list)} 条字幕")
-
-            # 输出
-            print(f"[VideoOverlay] 开始合成视频...")
-            output_stream = ffmpeg.output(
-                video_out,
-                audio_out,
-                output_path,
-                t=max_dur,
-                vcodec='libx264',
-                preset='medium',
-                crf=23,
-                acodec='aac',
-                **{'movflags': '+faststart'}
-            )
 
-            # 执行
-            ffmpeg.run(output_stream, overwrite_output=True, capture_stderr=True, quiet=True)
+class VideoGraphRenderNode:
+    """渲染 VIDEO_GRAPH：把 lazy_output 节点链编译成一个 ffmpeg 进程，不写中间文件"""
 
-            print(f"[VideoOverlay] ✓ 合成完成: {output_filename}")
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "video_graph": ("VIDEO_GRAPH",),
+            }
+        }
 
-            return {"ui": {"videos": [output_filename]}, "result": (output_path,)}
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("video_path",)
+    FUNCTION = "render_graph"
+    OUTPUT_NODE = True
+    CATEGORY = "video"
 
-        except ffmpeg.Error as e:
-            error_msg = e.stderr.decode('utf-8') if e.stderr else str(e)
-            print(f"[VideoOverlay] ✗ FFmpeg错误:\n{error_msg}")
-            raise RuntimeError(f"视频合成失败: {error_msg}")
-        except Exception as e:
-            print(f"[VideoOverlay] ✗ 处理失败: {e}")
-            raise
+    def render_graph(self, video_graph):
+        """按视频图最后一个节点的编码参数渲染"""
+        output_path = video_graph.render()
+        return {"ui": {"videos": [video_graph.output_filename]}, "result": (output_path,)}
 
 
 class Alignment2StringNode:
@@ -1180,7 +3577,8 @@ class String2AlignmentNode:
                     "default": "[]",
                     "multiline": True,
                 }),
-            }
+            },
+            "optional": cue_merge_input_types(),
         }
 
     RETURN_TYPES = ("whisper_alignment",)
@@ -1188,8 +3586,9 @@ class String2AlignmentNode:
     FUNCTION = "string_to_alignment"
     CATEGORY = "whisper"
 
-    def string_to_alignment(self, alignment_string):
-        """将 JSON 字符串转换为 alignment"""
+    def string_to_alignment(self, alignment_string, merge_cues=False, cue_max_gap=0.3, cue_max_chars=42,
+                            cue_max_duration=6.0):
+        """将 JSON 字符串转换为 alignment；merge_cues 时合并为整行字幕（输出仍是普通列表）"""
         import json
 
         if not alignment_string or alignment_string.strip() == "":
@@ -1198,6 +3597,10 @@ class String2AlignmentNode:
         try:
             alignment = json.loads(alignment_string)
             if isinstance(alignment, list):
+                if merge_cues:
+                    track = AlignmentTrack.from_segments(alignment)
+                    alignment = track.coalesce(cue_max_gap, cue_max_chars, cue_max_duration).to_list()
+                    print(f"[String2Alignment] {len(track)} 条字幕合并为 {len(alignment)} 行")
                 return (alignment,)
             else:
                 print("[String2Alignment] 警告: 解析的结果不是列表，返回空列表")
@@ -1214,6 +3617,9 @@ class String2AlignmentNode:
 NODE_CLASS_MAPPINGS = {
     "VideoOverlayNode": VideoOverlayNode,
     "VideoOverlayWithSubtitlesNode": VideoOverlayWithSubtitlesNode,
+    "VideoOverlayBatchNode": VideoOverlayBatchNode,
+    "VideoOverlayMultiLayerNode": VideoOverlayMultiLayerNode,
+    "VideoGraphRenderNode": VideoGraphRenderNode,
     "Alignment2StringNode": Alignment2StringNode,
     "String2AlignmentNode": String2AlignmentNode
 }
@@ -1221,6 +3627,9 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     "VideoOverlayNode": "Video Overlay (画中画合成)",
     "VideoOverlayWithSubtitlesNode": "Video Overlay with Subtitles (画中画+字幕)",
+    "VideoOverlayBatchNode": "Video Overlay Batch (批量画中画合成)",
+    "VideoOverlayMultiLayerNode": "Video Overlay Multi-Layer (多图层画中画合成)",
+    "VideoGraphRenderNode": "Render Video Graph (渲染视频图)",
     "Alignment2StringNode": "Alignment to String (对齐数据转字符串)",
     "String2AlignmentNode": "String to Alignment (字符串转对齐数据)"
 }
\ No newline at end of file
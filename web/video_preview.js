@@ -14,8 +14,9 @@ app.registerExtension({
     async beforeRegisterNodeDef(nodeType, nodeData, app) {
         console.log("[VideoOverlay] Checking node:", nodeData.name);
 
-        // 只处理 VideoOverlayNode 和 VideoOverlayWithSubtitlesNode
-        if (nodeData.name !== "VideoOverlayNode" && nodeData.name !== "VideoOverlayWithSubtitlesNode") {
+        // 只处理输出单个视频的 VideoOverlayNode、VideoOverlayWithSubtitlesNode、VideoOverlayMultiLayerNode 和 VideoGraphRenderNode
+        if (nodeData.name !== "VideoOverlayNode" && nodeData.name !== "VideoOverlayWithSubtitlesNode" &&
+            nodeData.name !== "VideoOverlayMultiLayerNode" && nodeData.name !== "VideoGraphRenderNode") {
             return;
         }
 